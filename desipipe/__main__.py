@@ -4,26 +4,32 @@ import sys
 from .task_manager import action_from_args
 
 
-def main():
+def main(argv=None):
+    """
+    Command line entry point, e.g. ``main(['queues', '-q', 'test'])``.
+    If ``argv`` is ``None``, arguments are taken from ``sys.argv``.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
 
     help_msg = 'Add one of the following commands and its arguments (`<command> -h` for help):\n'
     for action, description in action_from_args.actions.items():
         help_msg += '{}: {}\n'.format(action, description)
 
     try:
-        command_or_input = sys.argv[1].lower()
+        command_or_input = argv[0].lower()
     except IndexError:  # no command
         print(help_msg)
-        exit()
+        return 0
 
     if command_or_input in ['-h', '--help']:
         print(help_msg)
-        exit()
+        return 0
 
-    sys.argv.pop(1)
-    action_from_args(command_or_input)
+    action_from_args(command_or_input, args=list(argv[1:]))
+    return 0
 
 
 if __name__ == '__main__':
 
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -34,7 +34,7 @@ class Config(BaseDict):
 
         if os.path.isfile(self.config_fn):
             with open(self.config_fn, 'r') as file:
-                self.data = yaml_parser(file.read())[0]
+                self.data = next(yaml_parser(file.read()), None) or {}
             try:
                 with open(self.config_fn, 'a'): pass
             except PermissionError:  # from now on, write to home
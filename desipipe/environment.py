@@ -78,7 +78,7 @@ class BaseEnvironment(BaseDict, metaclass=RegisteredEnvironment):
         If ``all``, also include environment variables defined by :attr:`command`.
         """
         new = self.copy()
-        if all:
+        if all and self.command:
             new.update(bash_env(self.command))
         return dict(new)
 
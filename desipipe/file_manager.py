@@ -1,10 +1,11 @@
 import os
 import glob
 import re
-import copy
+import math
 import shutil
 import itertools
 import tempfile
+import threading
 
 import yaml
 
@@ -14,7 +15,12 @@ from .environment import get_environ
 from .io import get_filetype
 
 
-class YamlLoader(yaml.SafeLoader):
+# Use libyaml bindings if available, much faster than the pure-Python implementation
+_BaseLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+_BaseDumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+class YamlLoader(_BaseLoader):
     """
     *yaml* loader that correctly parses numbers.
     Taken from https://stackoverflow.com/questions/30458977/yaml-loads-5e-6-as-string-and-not-a-number.
@@ -22,17 +28,20 @@ class YamlLoader(yaml.SafeLoader):
 
 
 # https://stackoverflow.com/questions/30458977/yaml-loads-5e-6-as-string-and-not-a-number
-YamlLoader.add_implicit_resolver(u'tag:yaml.org,2002:float',
-                                 re.compile(u'''^(?:
-                                 [-+]?(?:[0-9][0-9_]*)\\.[0-9_]*(?:[eE][-+]?[0-9]+)?
-                                 |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
-                                 |\\.[0-9_]+(?:[eE][-+][0-9]+)?
-                                 |[-+]?[0-9][0-9_]*(?::[0-5]?[0-9])+\\.[0-9_]*
-                                 |[-+]?\\.(?:inf|Inf|INF)
-                                 |\\.(?:nan|NaN|NAN))$''', re.X),
-                                 list(u'-+0123456789.'))
-
-YamlLoader.add_implicit_resolver('!none', re.compile('None$'), first='None')
+_FLOAT_RE = re.compile(u'''^(?:
+                       [-+]?(?:[0-9][0-9_]*)\\.[0-9_]*(?:[eE][-+]?[0-9]+)?
+                       |[-+]?(?:[0-9][0-9_]*)(?:[eE][-+]?[0-9]+)
+                       |\\.[0-9_]+(?:[eE][-+][0-9]+)?
+                       |[-+]?[0-9][0-9_]*(?::[0-5]?[0-9])+\\.[0-9_]*
+                       |[-+]?\\.(?:inf|Inf|INF)
+                       |\\.(?:nan|NaN|NAN))$''', re.X)
+_NONE_RE = re.compile('None$')
+# Regular expressions used in hot paths: range(...) options and ${...} environment placeholders
+_RANGE_RE = re.compile(r'range\((.*)\)$')
+_PLACEHOLDER_RE = re.compile(r'\$\{(.*?)\}')
+
+YamlLoader.add_implicit_resolver(u'tag:yaml.org,2002:float', _FLOAT_RE, list(u'-+0123456789.'))
+YamlLoader.add_implicit_resolver('!none', _NONE_RE, first='None')
 
 
 def none_constructor(loader, node):
@@ -42,9 +51,20 @@ def none_constructor(loader, node):
 YamlLoader.add_constructor('!none', none_constructor)
 
 
+class YamlDumper(_BaseDumper):
+    """*yaml* dumper that writes lists in flow style."""
+
+
+def list_representer(dumper, data):
+    return dumper.represent_sequence(u'tag:yaml.org,2002:seq', data, flow_style=True)
+
+
+YamlDumper.add_representer(list, list_representer)
+
+
 def yaml_parser(string):
-    """Parse string in *yaml* format."""
-    return list(yaml.load_all(string, Loader=YamlLoader))
+    """Parse string (or bytes) in *yaml* format; return a generator over documents."""
+    return yaml.load_all(string, Loader=YamlLoader)
 
 
 class BaseFile(BaseClass):
@@ -73,6 +93,10 @@ class BaseFile(BaseClass):
         Plain text describing the file(s).
     """
     _defaults = dict(filetype='', path='', id='', author='', options=dict(), foptions=dict(), description='')
+    _default_keys = frozenset(_defaults)
+    # No instance __dict__, as many file entries / files may be created
+    __slots__ = ('filetype', 'path', 'id', 'author', 'options', 'foptions', 'description', 'environ',
+                 '_filepath', '_description_lower', '_description_words')
 
     def __init__(self, *args, **kwargs):
         """
@@ -90,27 +114,53 @@ class BaseFile(BaseClass):
             raise ValueError('Cannot take several args')
         if len(args):
             if isinstance(args[0], self.__class__):
-                self.__dict__.update(args[0].__dict__)
+                self.__setstate__(args[0].__getstate__())
                 return
             kwargs = {**args[0], **kwargs}
-        for name, value in self._defaults.items():
-            setattr(self, name, copy.copy(value))
+        # Same as :attr:`_defaults`, without going through copy.copy
+        self.filetype, self.path, self.id, self.author, self.description = '', '', '', '', ''
+        self.options, self.foptions = {}, {}
         self.update(**kwargs)
 
     def clone(self, **kwargs):
-        """Return an updated copy."""
+        """
+        Return an updated copy.
+        Attributes that are not updated (e.g. ``options``) are shared with this instance, not copied:
+        :meth:`update` replaces them rather than modifying them in place.
+        """
         new = self.copy()
         new.update(**kwargs)
         return new
 
     def update(self, **kwargs):
         """Update input attributes."""
+        try:
+            del self._filepath  # reset cached file path, see :attr:`File.filepath`
+        except AttributeError:
+            pass
         for name, value in kwargs.items():
-            if name in self._defaults:
+            if name in self._default_keys:
                 setattr(self, name, type(self._defaults[name])(value))
             else:
                 raise ValueError('Unknown argument {}; supports {}'.format(name, list(self._defaults)))
 
+    def __getstate__(self):
+        """Return state, i.e. all attributes that are set, except cached (private) ones, which are recomputed on demand."""
+        return {name: getattr(self, name) for name in BaseFile.__slots__ if not name.startswith('_') and hasattr(self, name)}
+
+    def __setstate__(self, state):
+        """Set state."""
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __copy__(self):
+        """Return a shallow copy (including cached attributes)."""
+        new = self.__class__.__new__(self.__class__)
+        for name in BaseFile.__slots__:
+            if hasattr(self, name):
+                setattr(new, name, getattr(self, name))
+        return new
+
     def to_dict(self):
         """View as a dictionary (of attributes)."""
         return {name: getattr(self, name) for name in self._defaults}
@@ -156,11 +206,29 @@ def in_options(values, options, return_index=False):
         raise ValueError('Cannot match values {} with options {}'.format(values, options))
     toret, index = [], []
     options = list(options)
+    # Map option values to their (first) index for constant-time lookup; options may not be hashable, e.g. lists
+    try:
+        lookup = {}
+        for ii, option in enumerate(options):
+            lookup.setdefault(option, ii)
+    except TypeError:
+        lookup = None
+
+    def find(value):
+        if lookup is not None:
+            try:
+                return lookup.get(value, None)
+            except TypeError:
+                pass
+        if value in options:
+            return options.index(value)
+        return None
+
     for value in values:
         if type(value) is not type(options[0]):
             value = type(options[0])(value)
-        if value in options:
-            ii = options.index(value)
+        ii = find(value)
+        if ii is not None:
             toret.append(options[ii])
             index.append(ii)
     if return_index:
@@ -172,24 +240,45 @@ class FileEntry(BaseFile):
 
     """Class describing a file entry."""
 
+    __slots__ = ()
+
     def update(self, **kwargs):
         """Update input attributes (options values are turned into lists)."""
         super(FileEntry, self).update(**kwargs)
-        
+
+        if 'description' in kwargs:
+            try:
+                del self._description_lower  # reset cached description, see :meth:`_get_description`
+            except AttributeError:
+                pass
         if 'options' in kwargs:
             options, foptions = {}, {}
             for name, values in kwargs['options'].items():
                 if isinstance(values, dict):
                     foptions[name] = list(values.keys())
                     values = list(values.values())
-                if isinstance(values, str) and re.match(r'range\((.*)\)$', values):
-                    values = eval(values)
+                match = _RANGE_RE.match(values) if isinstance(values, str) else None
+                if match:
+                    try:
+                        values = range(*[int(arg) for arg in match.group(1).split(',') if arg.strip()])
+                    except (ValueError, TypeError) as exc:
+                        raise ValueError('Cannot interpret option {} = {} as a range'.format(name, values)) from exc
                 options[name] = values = _make_list_options(values)
                 foptions.setdefault(name, values)
             self.options, self.foptions = options, foptions
         if 'foptions' in kwargs:
             self.foptions = dict(kwargs['foptions'])
 
+    def _get_description(self):
+        # """Return lower-case description and its words, cached for keyword search in :meth:`FileEntryCollection.index`."""
+        try:
+            return self._description_lower, self._description_words
+        except AttributeError:
+            pass
+        self._description_lower = self.description.lower()
+        self._description_words = frozenset(self._description_lower.split())
+        return self._description_lower, self._description_words
+
     def select(self, **kwargs):
         """
         Restrict to input options, e.g.
@@ -198,6 +287,9 @@ class FileEntry(BaseFile):
 
         returns a new entry, with option 'region' taking values in ``['NGC']``.
         """
+        if not kwargs:
+            return self.copy()
+
         def eq(test, ref):
             if type(test) is not type(ref):
                 if hasattr(test, '__iter__') and hasattr(ref, '__iter__'):
@@ -211,7 +303,9 @@ class FileEntry(BaseFile):
                 foptions[name] = [foptions[name][index] for index in indices]
             else:
                 raise ValueError('Unknown option {}, select from {}'.format(name, self.options))
-        return self.clone(options=options, foptions=foptions)
+        new = self.copy()
+        new.options, new.foptions = options, foptions  # already valid options, no need to go through update
+        return new
     
     def get(self, *args, **kwargs):
         """
@@ -230,40 +324,72 @@ class FileEntry(BaseFile):
 
     def __len__(self):
         """Length, i.e. number of individual files (looping over all options) described by this file entry."""
-        size = 1
-        for values in self.options.values():
-            size *= len(values)
-        return size
+        return math.prod(len(values) for values in self.options.values())
 
     def __iter__(self):
         """Iterate over all files (looping over all options) described by this file entry."""
-        for ivalues in itertools.product(*(range(len(values)) for values in self.options.values())):
-            options, foptions = {}, {}
-            for iname, name in enumerate(self.options):
-                ivalue = ivalues[iname]
-                options[name], foptions[name] = self.options[name][ivalue], self.foptions[name][ivalue]
-            fi = File()
-            fi.__dict__.update(self.__dict__)
-            fi.options, fi.foptions = options, foptions
+        state = self.__getstate__()
+        names = list(self.options)
+        # Option values and formatted values are kept as columns: pair them once, then take the product
+        columns = [list(zip(self.options[name], self.foptions[name])) for name in names]
+        # Environ placeholders are the same for all files: replaced once, see :attr:`File.filepath`
+        path = _replace_environ(self.path, getattr(self, 'environ', {}))
+        format = '{' in path or '}' in path
+        for values in itertools.product(*columns):
+            # No need to go through File.__init__ / update: attributes are copied from this (valid) entry
+            fi = File.__new__(File)
+            fi.__setstate__(state)
+            fi.options = {name: value[0] for name, value in zip(names, values)}
+            fi.foptions = {name: value[1] for name, value in zip(names, values)}
+            try:
+                fi._filepath = path.format(**fi.foptions) if format else path
+            except (KeyError, IndexError, ValueError):
+                pass  # error raised if :attr:`File.filepath` is accessed
             yield fi
 
 
+def _replace_environ(path, environ):
+    """Replace all ${...} placeholders of ``path`` (that are in ``environ``) in a single pass."""
+    if '$' in path:
+        path = _PLACEHOLDER_RE.sub(lambda match: environ.get(match.group(1), match.group(0)), path)
+    return path
+
+
+def _move_tree(src, dst):
+    """Move content of directory ``src`` into directory ``dst``, overwriting existing files."""
+    utils.mkdir(dst)
+    for name in os.listdir(src):
+        source, destination = os.path.join(src, name), os.path.join(dst, name)
+        if os.path.isdir(source) and os.path.isdir(destination):
+            _move_tree(source, destination)
+            os.rmdir(source)  # now empty
+            continue
+        try:
+            os.replace(source, destination)  # atomic rename on the same file system
+        except OSError:
+            shutil.move(source, destination)
+
+
 class File(BaseFile):
 
     """Class describing a single file (single option values)."""
 
+    __slots__ = ()
+    # Per-thread settings (e.g. ``write_attrs``, see :meth:`write`), as tasks writing files may run concurrently
+    local = threading.local()
+
     @property
     def filepath(self):
-        """Real path i.e. replacing placeholders in :attr:`path` by their value."""
-        path = self.path
-        environ = getattr(self, 'environ', {})
-        placeholders = re.finditer(r'\$\{.*?\}', path)
-        for placeholder in placeholders:
-            placeholder = placeholder.group()
-            placeholder_nobrackets = placeholder[2:-1]
-            if placeholder_nobrackets in environ:
-                path = path.replace(placeholder, environ[placeholder_nobrackets])
-        return path.format(**self.foptions)
+        """Real path i.e. replacing placeholders in :attr:`path` by their value; computed once, reset by :meth:`update`."""
+        try:
+            return self._filepath
+        except AttributeError:
+            pass
+        path = _replace_environ(self.path, getattr(self, 'environ', {}))
+        if '{' in path or '}' in path:
+            path = path.format(**self.foptions)
+        self._filepath = path
+        return path
 
     def read(self, *args, **kwargs):
         """Read file from disk."""
@@ -272,21 +398,22 @@ class File(BaseFile):
     def write(self, *args, **kwargs):
         """
         Write file to disk. First written in a temporary directory, then moved to its final destination.
-        To write additional files, a method :attr:`write_attrs`, that should take the path to the directory as input,
-        can be added to the current instance.
+        To write additional files, a function ``write_attrs``, that should take the file and the path to the directory as input,
+        can be set for the current thread with ``File.local.write_attrs = write_attrs``.
         """
-        write_attrs = getattr(self, 'write_attrs', None)
+        write_attrs = getattr(self.local, 'write_attrs', None)
         filepath = self.filepath
         dirname = os.path.dirname(filepath)
         utils.mkdir(dirname)
+        # Temporary directories are created in the destination directory, such that files are simply renamed
         if write_attrs is not None:
-            with tempfile.TemporaryDirectory() as tmp_dir:
-                new_dir = write_attrs(tmp_dir) or dirname
-                shutil.copytree(tmp_dir, new_dir, dirs_exist_ok=True)
-        with tempfile.TemporaryDirectory() as tmp_dir:
+            with tempfile.TemporaryDirectory(dir=dirname, prefix='.tmp_') as tmp_dir:
+                new_dir = write_attrs(self, tmp_dir) or dirname
+                _move_tree(tmp_dir, new_dir)
+        with tempfile.TemporaryDirectory(dir=dirname, prefix='.tmp_') as tmp_dir:
             path = os.path.join(tmp_dir, os.path.basename(filepath))
             toret = get_filetype(filetype=self.filetype, path=path).write(*args, **kwargs)
-            shutil.copytree(tmp_dir, dirname, dirs_exist_ok=True)
+            _move_tree(tmp_dir, dirname)
             return toret
 
     def __repr__(self):
@@ -343,18 +470,19 @@ class FileEntryCollection(BaseClass):
         self.data = []
 
         if utils.is_path(data):
-            if string is None: string = ''
-            with open(data, 'r') as file:
-                string += file.read()
+            with open(data, 'rb') as file:
+                raw = file.read()
+            if string is None and self.parser is yaml_parser:
+                string = raw  # yaml reads bytes directly, no need to decode
+            else:
+                string = (string or '') + raw.decode('utf-8')
         elif data is not None:
             if isinstance(data, (FileEntryCollection, FileManager)):
                 data = data.data
-            for dd in data:
-                self.append(dd)
+            self.extend(data)
 
         if string is not None:
-            for dd in self.parser(string, **kwargs):
-                self.append(dd)
+            self.extend(self.parser(string, **kwargs))
 
     def index(self, id=None, filetype=None, keywords=None, **kwargs):
         """
@@ -406,13 +534,14 @@ class FileEntryCollection(BaseClass):
             if filetype is not None and entry.filetype.lower() not in filetype:
                 continue
             if keywords is not None:
-                description = entry.description.lower()
-                if not any(all(kw in description for kw in keyword) for keyword in keywords):
+                description, words = entry._get_description()
+                if not any(all(kw in words or kw in description for kw in keyword) for keyword in keywords):
+                    continue
+            if kwargs:
+                try:
+                    entry = entry.select(**kwargs)
+                except ValueError:
                     continue
-            try:
-                entry = entry.select(**kwargs)
-            except ValueError:
-                continue
             if not entry:
                 continue
             index.append(ientry)
@@ -514,18 +643,19 @@ class FileEntryCollection(BaseClass):
         entry.environ = self.environ
         self.data.append(entry)
 
+    def extend(self, entries):
+        """Append input file entries, each of which may be e.g. a dictionary, or a :class:`FileEntry` instance."""
+        entries = [FileEntry(entry) for entry in entries]
+        for entry in entries:
+            entry.environ = self.environ
+        self.data.extend(entries)
+
     def write(self, fn):
         """Write data base to *yaml* file ``fn``."""
         utils.mkdir(os.path.dirname(fn))
 
         with open(fn, 'w') as file:
-
-            def list_rep(dumper, data):
-                return dumper.represent_sequence(u'tag:yaml.org,2002:seq', data, flow_style=True)
-
-            yaml.add_representer(list, list_rep)
-
-            yaml.dump_all([utils.dict_to_yaml(entry.to_dict()) for entry in self.data], file, default_flow_style=False)
+            yaml.dump_all([utils.dict_to_yaml(entry.to_dict()) for entry in self.data], file, Dumper=YamlDumper, default_flow_style=False)
 
     def __copy__(self):
         """Return a shallow copy (data list is copied)."""
@@ -537,7 +667,7 @@ class FileEntryCollection(BaseClass):
         """Update :attr:`data` (list of :class:`FileEntry`) or :attr:`environ` (dict)."""
         if 'data' in kwargs:
             self.data = []
-            for entry in kwargs.pop('data'): self.append(entry)
+            self.extend(kwargs.pop('data'))
         if 'environ' in kwargs:
             environ = kwargs.pop('environ')
             for entry in self.data:
@@ -554,8 +684,7 @@ class FileEntryCollection(BaseClass):
     def __add__(self, other):
         """Sum of `self`` + ``other``."""
         new = self.copy()
-        for entry in other.data:
-            new.append(entry)
+        new.extend(other.data)
         return new
 
     def __radd__(self, other):
@@ -563,8 +692,10 @@ class FileEntryCollection(BaseClass):
         return self.__add__(other)
 
     def __iadd__(self, other):
-        if other == 0: return self.copy()
-        return self.__add__(other)
+        """In-place sum ``self += other``, i.e. append file entries of ``other`` (without copying ``self``)."""
+        if other == 0: return self
+        self.extend(other.data)
+        return self
 
     @property
     def filepaths(self):
@@ -620,13 +751,15 @@ class FileManager(FileEntryCollection):
             return
 
         options = self.options
+        if not all(options.values()):  # no common option values
+            return
 
+        names = list(options)
         for values in itertools.product(*options.values()):
-            opt = {name: [values[iname]] for iname, name in enumerate(options)}
+            opt = dict(zip(names, ([value] for value in values)))
             database = self.clone(data=[])
-            for entry in self.data:
-                entry = entry.select(**{**entry.options, **opt})
-                database.append(entry)
+            # Only common options are restricted; entries (sharing environ with self) are directly appended
+            database.data = [entry.select(**opt) for entry in self.data]
             yield database
             
     @classmethod
@@ -72,9 +72,10 @@ class TextFile(BaseFile):
             return file.read()
 
     def write(self, txt):
-        """Write file."""
-        utils.mkdir(os.path.dirname(txt))
-        with open(self.path, 'w') as file:
+        """Write file; ``txt`` may be a string, or already encoded (bytes)."""
+        utils.mkdir(os.path.dirname(self.path))
+        mode = 'wb' if isinstance(txt, (bytes, bytearray)) else 'w'
+        with open(self.path, mode) as file:
             file.write(txt)
 
 
@@ -2,7 +2,10 @@ import os
 import time
 import copy
 import random
+import shlex
 import subprocess
+import traceback
+import concurrent.futures
 
 from .utils import BaseClass
 
@@ -149,6 +152,65 @@ class LocalProvider(BaseProvider):
         return 10.
 
 
+class ThreadProvider(LocalProvider):
+    """
+    Thread provider: input commands are run in a persistent pool of threads of the current (manager) process,
+    saving the start-up of a new process for each worker; best suited to many short tasks.
+    Input commands must be desipipe command lines, e.g. 'desipipe work --queue ...'.
+
+    Note
+    ----
+    Tasks are run in the environment of the current process: :attr:`environ` cannot be applied to threads
+    (a warning is logged if one other than the default is given). Each worker has its own single-process MPI communicator.
+    """
+    name = 'thread'
+    _defaults = dict()
+    mpiprocs_per_worker = 1  # no MPI, see :meth:`LocalProvider.cost`
+
+    def __init__(self, *args, **kwargs):
+        super(ThreadProvider, self).__init__(*args, **kwargs)
+        self.pool = None
+
+    def update(self, **kwargs):
+        """Update provider with input attributes."""
+        super(ThreadProvider, self).update(**kwargs)
+        if kwargs.get('environ', None) is not None:  # default environment is not warned about
+            from .environment import get_environ
+            default = get_environ()
+            if (self.environ.name, self.environ.to_dict(), self.environ.command) != (default.name, default.to_dict(), default.command):
+                self.log_warning('environ is not applied by {}: tasks are run in the environment of the current process'.format(self.__class__.__name__))
+
+    def __call__(self, cmd, workers=1):
+        """Submit input command ``cmd`` on ``workers`` workers."""
+        from .__main__ import main
+        if self.pool is None:  # created on first call, and kept for next ones
+            self.pool = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='desipipe')
+        argv = shlex.split(cmd)[1:]  # remove 'desipipe'
+        for worker in range(workers):
+            self.processes.append(self.pool.submit(main, argv))
+
+    def nrunning(self):
+        """Number of running workers; exceptions raised by workers that are done are logged."""
+        running = []
+        for process in self.processes:
+            if not process.done():
+                running.append(process)
+                continue
+            exc = process.exception()
+            if exc is not None:
+                self.log_error('Worker failed:\n{}'.format(''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))))
+        self.processes = running
+        return len(running)
+
+    def __getstate__(self):
+        """Return provider state, without the thread pool and running workers."""
+        return {name: value for name, value in self.__dict__.items() if name not in ['pool', 'processes']}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pool, self.processes = None, []
+
+
 class SlurmProvider(BaseProvider):
     """
     Slurm provider: input commands are submitted as Slurm jobs.
@@ -94,13 +94,20 @@ class SimpleScheduler(BaseScheduler):
     ----------
     max_workers : int, default=1
         Maximum number of workers.
+
+    nbatch : int, default=1
+        Number of tasks each worker pops from the queue at once (passed to 'desipipe work');
+        I/O-bound tasks popped together are run concurrently, see :func:`task_manager.work`.
     """
     name = 'simple'
-    _defaults = dict(max_workers=1)
+    _defaults = dict(max_workers=1, nbatch=1)
 
     def __call__(self, cmd, ntasks=None):
         if ntasks is None:
             ntasks = 1
+        if self.nbatch > 1:
+            cmd = '{} --nbatch {:d}'.format(cmd, self.nbatch)
+            ntasks = (ntasks + self.nbatch - 1) // self.nbatch  # number of workers needed
         nrunning = self.provider.nrunning()
         max_workers = min(ntasks, self.max_workers - nrunning)
         best_workers, best_cost = 0, float('inf')
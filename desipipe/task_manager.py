@@ -2,11 +2,14 @@ import os
 import re
 import io
 import sys
+import copy
 import contextlib
 import time
 import random
 import uuid
 import signal
+import threading
+import json
 import pickle
 import subprocess
 import traceback
@@ -18,6 +21,10 @@ import glob
 import textwrap
 import copyreg
 import shutil
+import shlex
+import itertools
+import concurrent.futures
+from collections import OrderedDict
 
 import sqlite3
 
@@ -106,6 +113,7 @@ class TaskPickler(pickle.Pickler):
 
     def __init__(self, *args, reduce_app=reduce_app, **kwargs):
         """Initialize pickler and add the special reduce method for :class:`BaseApp` to the :attr:`dispatch_table`."""
+        if len(args) < 2: kwargs.setdefault('protocol', pickle.HIGHEST_PROTOCOL)
         super(TaskPickler, self).__init__(*args, **kwargs)
         self.dispatch_table = copyreg.dispatch_table.copy()
         if reduce_app:
@@ -143,6 +151,22 @@ class TaskPickler(pickle.Pickler):
         return f.getvalue()
 
 
+class HashWriter(object):
+
+    """File-like object that hashes all written bytes, e.g. to hash a pickle without keeping it in memory."""
+
+    def __init__(self, digest_size=16):
+        self.hash = hashlib.blake2b(digest_size=digest_size)
+
+    def write(self, data):
+        self.hash.update(data)
+        return len(data)
+
+    def hexdigest(self):
+        """Return hash, as a string of hexadecimal digits."""
+        return self.hash.hexdigest()
+
+
 class TaskUnpickler(pickle.Unpickler):
     """
     Unpickler that corresponds to :class:`TaskPickler`,
@@ -177,38 +201,10 @@ class TaskUnpickler(pickle.Unpickler):
         return cls(f, *args, **kwargs).load()
 
 
-class TaskManagerPickler(pickle.Pickler):
-
-    """Special pickler for tasks, handling :class:`BaseApp` and :class:`Future` instances."""
-
-    def persistent_id(self, obj):
-        # Instead of pickling obj as a regular class instance, we emit a persistent ID.
-        if isinstance(obj, TaskManager):
-            # Here, our persistent ID is simply a tuple, containing a tag and a
-            # key, which refers to a specific record in the database.
-            state = obj.__getstate__()
-            state['queue'] = None
-            return ('TaskManager', state)
-
-        # If obj does not have a persistent ID, return None. This means obj
-        # needs to be pickled as usual.
-        return None
-
-    @classmethod
-    def dumps(cls, obj, *args, **kwargs):
-        """
-        Dump input ``obj`` to string.
-        args and kwargs are passed to :meth:`__init__`.
-        """
-        f = io.BytesIO()
-        cls(f, *args, **kwargs).dump(obj)
-        return f.getvalue()
-
-
 class TaskManagerUnpickler(pickle.Unpickler):
     """
-    Unpickler that corresponds to :class:`TaskPickler`,
-    replacing :class:`Future` instances by the actual result of the computation.
+    Unpickler for :class:`TaskManager` instances saved as pickles, in queues written before
+    task managers were saved as JSON (see :meth:`TaskManager.to_dict`).
     """
     def __init__(self, file, queue=None):
         super().__init__(file)
@@ -285,7 +281,8 @@ class Task(BaseClass):
     dtime : float
         Running time of :class:`BaseApp.run`.
     """
-    _attrs = ['id', 'app', 'index', 'kwargs', 'require_ids', 'state', 'jobid', 'errno', 'err', 'out', 'versions', 'result', 'dtime']
+    _attrs = ('id', 'app', 'index', 'kwargs', 'require_ids', 'state', 'jobid', 'errno', 'err', 'out', 'versions', 'result', 'dtime')
+    __slots__ = _attrs
 
     def __init__(self, app, kwargs=None, state=None):
         """
@@ -303,6 +300,7 @@ class Task(BaseClass):
             Task state. Defaults to 'WAITING' if this task requires others to be run,
             else to 'PENDING'.
         """
+        self.versions = {}
         self.result = None
         self.dtime = None
         self.update(app=app, kwargs=kwargs, state=state, jobid='', errno=None, err='', out='')
@@ -320,10 +318,9 @@ class Task(BaseClass):
 
         if not hasattr(self, 'require_ids') or require_id:
             try:
-                f = io.BytesIO()
-                pickler = TaskPickler(f)
+                uid = HashWriter()  # pickle is directly hashed, never held in memory
+                pickler = TaskPickler(uid)
                 pickler.dump((self.app.name, self.app.code, self.kwargs))
-                uid = f.getvalue()
                 self.require_ids = list(getattr(pickler, 'future_ids', []))
             except (AttributeError, pickle.PicklingError) as exc:
                 raise SerializationError('Make sure the task function, args and kwargs are picklable') from exc
@@ -336,8 +333,7 @@ class Task(BaseClass):
                 else:
                     self.state = TaskState.PENDING
         if require_id:
-            hex = hashlib.md5(uid).hexdigest()
-            self.id = str(uuid.UUID(hex=hex))  # unique ID, tied to the given app, args and kwargs
+            self.id = str(uuid.UUID(hex=uid.hexdigest()))  # unique ID, tied to the given app, args and kwargs
         for name in ['jobid', 'errno', 'err', 'out', 'result', 'dtime']:
             if name in kwargs:
                 setattr(self, name, kwargs.pop(name))
@@ -382,9 +378,9 @@ class Task(BaseClass):
                 shutil.copytree(self.app.dirname, dirname, dirs_exist_ok=True)
             return self.app.write_dir  # destination
 
-        File.write_attrs = write_attrs  # save main script and versions whenever a file is written to disk
+        File.local.write_attrs = write_attrs  # save main script and versions whenever a file is written to disk (by this thread)
         self.errno, self.result, self.err, self.out, self.versions = self.app.run(**{**self.kwargs, **kwargs})
-        File.write_attrs = None
+        File.local.write_attrs = None
         if self.errno:
             if self.errno == signal.SIGTERM:
                 self.state = TaskState.KILLED
@@ -395,9 +391,32 @@ class Task(BaseClass):
         self.dtime = time.time() - t0
 
     def __getstate__(self):
-        """Return the task state (called by pickler)."""
+        """Return the task state."""
         return {name: getattr(self, name) for name in self._attrs if hasattr(self, name)}
 
+    def __setstate__(self, state):
+        """Set the task state (also used to unpickle tasks saved as dictionaries)."""
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __copy__(self):
+        new = self.__class__.__new__(self.__class__)
+        new.__setstate__(self.__getstate__())
+        return new
+
+    def __reduce__(self):
+        """Reduce to the tuple of attribute values (called by pickler), without attribute names."""
+        # Task._from_state is a bound method, hence not caught by TaskPickler as a function to serialize
+        return (self.__class__._from_state, (tuple(getattr(self, name, None) for name in self._attrs),))
+
+    @classmethod
+    def _from_state(cls, values):
+        # """Rebuild task from the tuple of attribute values returned by :meth:`__reduce__`."""
+        new = cls.__new__(cls)
+        for name, value in zip(cls._attrs, values):
+            setattr(new, name, value)
+        return new
+
 
 class Future(BaseClass):
 
@@ -431,25 +450,32 @@ def _make_getter(name):
             Return ``None`` after this delay (in seconds) if no success.
 
         timestep : float, default=1.
-            Period (in seconds) at which the queue is queried.
+            Maximum period (in seconds) at which the queue is queried;
+            the queue is first queried more often (exponential backoff), such that results of short tasks are quickly returned.
 
         Returns
         -------
         {0} : object
-            Value returned by :class:`BaseApp.func`.
+            Value returned by :class:`BaseApp.func`; ``None`` if the task is not in the queue.
         """.format(name)
         t0 = time.time()
         try:
             return getattr(self, '_' + name)
         except AttributeError:
+            ntries = 0
             while True:
                 if (time.time() - t0) < timeout:
-                    if self.queue.tasks(tid=self.id, property='state') not in (TaskState.WAITING, TaskState.PENDING):
-                        # print(self.queue.tasks(self.id)[0].err)
-                        tmp = getattr(self.queue.tasks(tid=self.id), name)
+                    # Single query for both the state and the task
+                    row = self.queue._query(['SELECT state, task FROM tasks WHERE tid=?', (self.id,)]).fetchone()
+                    if row is None:
+                        self.log_error('task {} not found in queue {}'.format(self.id, self.queue.filename))
+                        return None
+                    if row[0] not in (TaskState.WAITING, TaskState.PENDING, TaskState.RUNNING):
+                        tmp = getattr(TaskUnpickler.loads(row[1], queue=self.queue), name)
                         setattr(self, '_' + name, tmp)
                         return tmp
-                    time.sleep(timestep * random.uniform(0.8, 1.2))
+                    time.sleep(min(timestep, 0.05 * 2**ntries) * random.uniform(0.8, 1.2))
+                    ntries += 1
                 else:
                     self.log_error('time out while getting {}'.format(name))
                     return None
@@ -461,24 +487,107 @@ for name in ['result', 'err', 'out']:
     setattr(Future, name, _make_getter(name))
 
 
+class FutureList(list):
+
+    """List of :class:`Future` (or ``None`` for skipped tasks), e.g. returned by :meth:`TaskManager.map`."""
+
+    def as_numpy(self, dtype='f8', timeout=1e4, timestep=1.):
+        """
+        Return task results as a numpy array, e.g. for scalar results.
+        Missing results (``None``, e.g. skipped tasks or time out) are set to NaN.
+
+        Parameters
+        ----------
+        dtype : str, np.dtype, default='f8'
+            Array type; must be a floating point (or complex) type if results are missing.
+
+        timeout : float, default=1e4
+            Time out after this delay (in seconds), see :meth:`Future.result`.
+
+        timestep : float, default=1.
+            Maximum period (in seconds) at which the queue is queried.
+
+        Returns
+        -------
+        array : np.ndarray
+        """
+        import numpy as np
+        toret = np.empty(len(self), dtype=dtype)
+        for ii, result in enumerate(self.result(timeout=timeout, timestep=timestep)):
+            if result is None:
+                if not np.issubdtype(toret.dtype, np.inexact):
+                    raise ValueError('Cannot set missing result {:d} in array of type {}'.format(ii, toret.dtype))
+                result = np.nan
+            toret[ii] = result
+        return toret
+
+
+def _make_list_getter(name):
+
+    def getter(self, timeout=1e4, timestep=1.):
+        """
+        Return the list of task {0}s, see :meth:`Future.{0}`.
+
+        Parameters
+        ----------
+        timeout : float, default=1e4
+            Return ``None`` for the remaining tasks after this delay (in seconds) if no success.
+
+        timestep : float, default=1.
+            Maximum period (in seconds) at which the queue is queried.
+
+        Returns
+        -------
+        {0} : list
+        """.format(name)
+        t0, toret = time.time(), []
+        for future in self:
+            if future is None:
+                toret.append(None)
+            else:
+                toret.append(getattr(future, name)(timeout=max(timeout - (time.time() - t0), 0.), timestep=timestep))
+        return toret
+
+    return getter
+
+
+for name in ['result', 'err', 'out']:
+    setattr(FutureList, name, _make_list_getter(name))
+
+
 queue_states = ['ACTIVE', 'PAUSED']
 
 
 QueueState = type('QueueState', (), {**dict(zip(queue_states, queue_states)), 'ALL': queue_states})
 
 
+_QUEUE_NAME_RE = re.compile(r'^[a-zA-Z0-9_/.-]+$')
+
+
 class Queue(BaseClass):
 
     """Queue keeping track of all tasks that have been run and to be run, with sqlite backend."""
 
-    def __init__(self, name, base_dir=None, create=None, spawn=False):
+    # Maximum number of unpickled tasks kept in memory
+    _max_cached_tasks = 1024
+    # Number of consecutive failures of a query before reconnecting, see :meth:`_query`
+    _max_query_tries = 5
+    # Indices for selections by task manager and / or state, and dependency look-ups
+    _indices_script = """
+    CREATE INDEX IF NOT EXISTS idx_tasks_mid_state ON tasks(mid, state);
+    CREATE INDEX IF NOT EXISTS idx_tasks_state ON tasks(state);
+    CREATE INDEX IF NOT EXISTS idx_requires_tid ON requires(tid);
+    CREATE INDEX IF NOT EXISTS idx_requires_require ON requires(require);
+    """
+
+    def __init__(self, name, base_dir=None, create=None, spawn=False, wal=None):
         """
         Initialize queue.
 
         Parameters
         ----------
         name : str
-            Name of queue; can contain alphanumeric characters, underscores and hyphens.
+            Name of queue; can contain alphanumeric characters, underscores, hyphens, dots and slashes (path separators).
             'this/queue' saves the queue as ``base_dir/this/queue.sqlite``.
             '/this/queue' saves the queue as '/this/queue.sqlite' (starting from root).
 
@@ -493,6 +602,12 @@ class Queue(BaseClass):
 
         spawn : bool, default=False
             If ``True``, spawn a manager process that will distribute the tasks among workers.
+
+        wal : bool, default=None
+            If ``True``, the created queue uses write-ahead logging (readers do not block the writer, and vice versa);
+            this requires all processes accessing the queue to run on the same host (e.g. not on a network file system shared by several nodes).
+            If ``None``, defaults to 'queue_wal' in :class:`Config` if provided, else ``False``.
+            The journal mode is saved in the queue itself: this is only relevant when creating the queue.
         """
         if isinstance(name, self.__class__):
             self.__dict__.update(name.__dict__)
@@ -501,13 +616,17 @@ class Queue(BaseClass):
         if base_dir is None:
             base_dir = Config().queue_dir
 
-        if re.match('^[a-zA-Z0-9_/.-]+$', name) is None:
-            raise ValueError('Input queue name {} must be alphanumeric plus underscores and hyphens'.format(name))
+        if _QUEUE_NAME_RE.match(name) is None:
+            raise ValueError('Input queue name {} must contain only alphanumeric characters, underscores, hyphens, dots and slashes'.format(name))
 
         if not name.endswith('.sqlite'):
             name += '.sqlite'
         self.filename = os.path.abspath(os.path.join(base_dir, name))
         self.dirname = os.path.dirname(self.filename)
+        self._managers = {}  # cache of task managers, see :meth:`managers`
+        self._tasks = OrderedDict()  # cache of unpickled tasks, see :meth:`_load_task`
+        self._batch = None  # tasks to be added at once, see :meth:`TaskManager.batch`
+        self._db = None  # connection to the data base, see :attr:`db`
 
         # Check if it already exists and/or if we are supposed to create it
         exists = os.path.exists(self.filename)
@@ -522,7 +641,9 @@ class Queue(BaseClass):
         if create:
             self.log_info('Creating queue {}'.format(self.filename))
             utils.mkdir(self.dirname, mode=0o700)
-            self.db = sqlite3.Connection(self.filename)
+            if wal is None:
+                wal = Config().get('queue_wal', False)
+            self._connect(wal=wal)
 
             # Give rw access to user but no one else
             os.chmod(self.filename, 0o600)
@@ -533,7 +654,8 @@ class Queue(BaseClass):
                 tid      TEXT PRIMARY KEY,
                 task     TEXT,
                 state    TEXT,
-                mid      TEXT  -- task manager id
+                mid      TEXT,  -- task manager id
+                pending_requires INTEGER DEFAULT 0  -- number of requirements that have not succeeded
             );
             -- Dependencies table.  Multiple entries for multiple deps.
             CREATE TABLE requires (
@@ -556,18 +678,58 @@ class Queue(BaseClass):
                 value TEXT
             );
             """
-            self.db.executescript(script)
+            self.db.executescript(script + self._indices_script)
             # Initial queue state is active
             self.db.execute('INSERT INTO metadata VALUES (?, ?)', ('state', QueueState.ACTIVE))
             self.db.commit()
-        else:
-            self.log_debug('Connection to queue {}'.format(self.filename))
-            self.db = sqlite3.Connection(self.filename, timeout=60)
         if spawn:
             cmd = ['desipipe', 'spawn', '--queue', self.filename]
             self.log_info('Spawning: {}'.format(' '.join(cmd)))
             subprocess.Popen(cmd, start_new_session=True, env=os.environ)
 
+    @property
+    def db(self):
+        """Connection to the data base, opened on first use and then kept for the lifetime of the queue."""
+        if self._db is None:
+            if not os.path.exists(self.filename):  # e.g. deleted
+                raise ValueError('Queue {} does not exist'.format(self.filename))
+            self.log_debug('Connection to queue {}'.format(self.filename))
+            self._connect()
+            # Queues created by previous versions may not have indices
+            self._db.executescript(self._indices_script)
+            self._add_pending_requires()
+        return self._db
+
+    def _connect(self, wal=False):
+        # """Open connection to the data base :attr:`db`; if ``wal``, switch the data base to write-ahead logging."""
+        # Autocommit mode: transactions are explicitly opened with :meth:`_get_lock`
+        self._db = sqlite3.connect(self.filename, timeout=60, isolation_level=None, check_same_thread=False, cached_statements=512)
+        # busy_timeout: wait for locks within sqlite
+        self._db.executescript('PRAGMA busy_timeout=60000; PRAGMA temp_store=MEMORY; PRAGMA cache_size=-20000;')
+        if wal:  # persistent: next connections use write-ahead logging as well
+            self._db.execute('PRAGMA journal_mode=WAL')
+        if self._db.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal':
+            # wal_autocheckpoint: checkpoint write-ahead log every 2000 pages (see also :meth:`_checkpoint`)
+            self._db.executescript('PRAGMA synchronous=NORMAL; PRAGMA wal_autocheckpoint=2000;')
+
+    def _add_pending_requires(self):
+        # """Add and fill column 'pending_requires' in queues created by previous versions."""
+        if 'pending_requires' in [row[1] for row in self.db.execute('PRAGMA table_info(tasks)')]:
+            return
+        self._get_lock()
+        try:
+            if 'pending_requires' not in [row[1] for row in self.db.execute('PRAGMA table_info(tasks)')]:  # may have been added in the meantime
+                self.db.execute('ALTER TABLE tasks ADD COLUMN pending_requires INTEGER DEFAULT 0')
+                self._count_pending_requires()
+        except Exception as exc:
+            self.db.rollback()
+            raise exc
+        self._release_lock()
+
+    def _checkpoint(self):
+        # """Write back the write-ahead log (if any, see :meth:`_connect`) into the data base and truncate it, such that the log does not grow unbounded."""
+        self._query('PRAGMA wal_checkpoint(TRUNCATE)')
+
     def _query(self, query, timeout=120., timestep=1., many=False):
         """
         Perform a database query, retrying if needed.
@@ -579,10 +741,11 @@ class Queue(BaseClass):
             where arguments is a tuple, or list of tuples if ``many`` is ``True``.
 
         timeout : float, default=120
-            After this delay (in seconds) without success, raise sqlite3.OperationalError.
+            After this delay (in seconds) without success, raise sqlite3.DatabaseError.
+            Only relevant for transient 'malformed' errors (e.g. on NFS); waiting for locks is handled by sqlite.
 
         timestep : float, default=1
-            Period (in seconds) at which the queue is queried.
+            Maximum period (in seconds) at which the query is retried (with exponential backoff).
 
         many : bool, default=False
             If ``True``, call the same query for the list of arguments (tuple).
@@ -596,10 +759,12 @@ class Queue(BaseClass):
         t0, ntries = time.time(), 1
         if isinstance(query, str):
             query = (query,)
+        if many:  # arguments may be an iterator (e.g. zip), which would be exhausted by the first try
+            query = (query[0], list(query[1]))
         while True:
             try:
                 if ntries > 1:
-                    self.log_debug('Retrying: "{}"'.format(' '.join(query)))
+                    self.log_debug('Retrying: "{}"'.format(query[0]))
 
                 if many:
                     result = self.db.executemany(*query)
@@ -611,48 +776,41 @@ class Queue(BaseClass):
 
                 return result
 
-            except (sqlite3.OperationalError, sqlite3.DatabaseError) as exc:
-                # A few known errors that can occur when multiple clients
-                # are hammering on the database. For these cases, wait
-                # and try again a few times before giving up.
-                known_excs = ['database is locked', 'database disk image is malformed']  # on NFS
-                if getattr(exc, 'message', '').lower() in known_excs:
-                    if (time.time() - t0) < timeout:
+            except sqlite3.DatabaseError as exc:
+                # Waiting for the database lock is handled by sqlite itself (busy timeout, see :meth:`_connect`).
+                # 'database disk image is malformed' may however transiently occur on NFS
+                # when multiple clients are hammering on the database: wait and try again.
+                if 'malformed' not in str(exc).lower():
+                    raise exc
+                if (time.time() - t0) < timeout:
+                    # Exponential backoff, keeping the same connection: reopening it on each try makes things worse on NFS
+                    time.sleep(min(timestep, 0.05 * 2**ntries) * random.uniform(0.8, 1.2))
+                    if ntries % self._max_query_tries == 0 and not self.db.in_transaction:
+                        # Error persists: reconnect (not within a transaction, which would be lost)
                         self.db.close()
-                        time.sleep(timestep * random.uniform(0.8, 1.2))
-                        self.db = sqlite3.Connection(self.filename)
-                        ntries += 1
-                    else:
-                        self.log_error('tried {} times and still getting errors'.format(ntries))
-                        raise exc
+                        self._connect()
+                    ntries += 1
                 else:
+                    self.log_error('tried {} times and still getting errors'.format(ntries))
                     raise exc
 
-    def _add_requires(self, tid, requires):
+    def _add_requires(self, requires):
         """
-        Add requirements for a task.
+        Add requirements for tasks.
 
         Parameters
         ----------
-        tid : str
-            Task ID.
-
         requires : list
-            List of IDs upon which this task depends.
+            List of tuples (task ID, ID upon which this task depends).
         """
-        query = 'INSERT OR REPLACE INTO requires (tid, require) VALUES (?, ?)'
-        if isinstance(requires, str):
-            self._query([query, (tid, requires)])
-        else:
-            args = [(tid, x) for x in requires]
-            self._query([query, args], many=True)
-        self.db.commit()
+        query = 'INSERT INTO requires (tid, require) VALUES (?, ?)'
+        self._query([query, requires], many=True)
 
-    def _add_manager(self, manager):
-        # """Add input :class:`TaskManager` to the data base (or replace if already there, as specified by :attr:`TaskManager.id`)."""
-        query = 'INSERT OR REPLACE INTO managers (mid, manager) VALUES (?, ?)'
-        self._query([query, (manager.id, TaskManagerPickler.dumps(manager))])
-        self.db.commit()
+    def _add_managers(self, managers):
+        # """Add input :class:`TaskManager` instances to the data base (if not already there, as specified by :attr:`TaskManager.id`)."""
+        query = 'INSERT OR IGNORE INTO managers (mid, manager) VALUES (?, ?)'
+        self._query([query, [(manager.id, json.dumps(manager.to_dict())) for manager in managers]], many=True)
+        # No need to invalidate cached task managers: same ID means same environ, scheduler and provider
 
     def add(self, tasks, replace=False):
         """
@@ -676,39 +834,54 @@ class Queue(BaseClass):
         isscalar = isinstance(tasks, Task)
         if isscalar:
             tasks = [tasks]
-        ids, requires, managers, states, tasks_serialized, futures = [], [], [], [], [], []
+        ids, requires, mids, states, previous_states, tasks_serialized, futures = [], [], [], [], [], [], []
+        managers, seen = {}, set()  # unique task managers and task IDs
+        # All insertions within a single transaction
         self._get_lock()
-        for task in tasks:
-            futures.append(Future(queue=self, tid=task.id))
-            manager = task.app.task_manager
-            if replace is None:
-                row = self._query(['SELECT state, mid FROM tasks WHERE tid=?', (task.id,)]).fetchone()
-                if row:
-                    state, mid = row
-                    if state in (TaskState.PENDING, TaskState.WAITING) and mid != manager.id:
-                        self._query(['REPLACE INTO tasks (tid, mid) VALUES (?, ?)', (task.id, mid)])
-                        managers.append(manager)
+        try:
+            for task in tasks:
+                futures.append(Future(queue=self, tid=task.id))
+                if task.id in seen:  # same task (app and arguments) input several times, e.g. within :meth:`TaskManager.batch`
                     continue
-            ids.append(task.id)
-            requires.append(task.require_ids)
-            managers.append(manager)
-            states.append(task.state)
-            tasks_serialized.append(TaskPickler.dumps(task))
-        query = 'INSERT'
-        if replace: query = 'REPLACE'
-        query += ' INTO tasks (tid, task, state, mid) VALUES (?,?,?,?)'
-        self._query([query, zip(ids, tasks_serialized, states, [tm.id for tm in managers])], many=True)
-        for tid, requires in zip(ids, requires):
-            self._add_requires(tid, requires)
-        for manager in managers:
-            self._add_manager(manager)
-        self.db.commit()
+                seen.add(task.id)
+                manager = task.app.task_manager
+                if replace is None:
+                    row = self._query(['SELECT state, mid FROM tasks WHERE tid=?', (task.id,)]).fetchone()
+                    if row:
+                        state, mid = row
+                        if state in (TaskState.PENDING, TaskState.WAITING) and mid != manager.id:
+                            self._query(['UPDATE tasks SET mid=? WHERE tid=?', (manager.id, task.id)])
+                            managers[manager.id] = manager
+                        continue
+                previous_state = None
+                if replace:
+                    row = self._query(['SELECT state FROM tasks WHERE tid=?', (task.id,)]).fetchone()
+                    if row: previous_state = row[0]
+                previous_states.append(previous_state)
+                ids.append(task.id)
+                if previous_state is None:  # requirements do not change for a given task ID
+                    requires += [(task.id, require) for require in task.require_ids]
+                mids.append(manager.id)
+                managers[manager.id] = manager
+                states.append(task.state)
+                tasks_serialized.append(TaskPickler.dumps(task))
+            query = 'INSERT INTO tasks (tid, task, state, mid) VALUES (?,?,?,?)'
+            # Upsert: requirements and their count (pending_requires) of tasks already in queue are kept
+            if replace: query += ' ON CONFLICT(tid) DO UPDATE SET task=excluded.task, state=excluded.state, mid=excluded.mid'
+            self._query([query, zip(ids, tasks_serialized, states, mids)], many=True)
+            # Requirements of new tasks are not in the table yet: only other tasks are updated
+            for tid, previous_state, state in zip(ids, previous_states, states):
+                self._update_pending_requires(tid, previous_state, state)
+            self._add_requires(requires)
+            self._count_pending_requires([tid for tid, previous_state in zip(ids, previous_states) if previous_state is None])
+            query = 'UPDATE tasks SET state=? WHERE tid=? AND state=? AND pending_requires=0'
+            self._query([query, [(TaskState.PENDING, tid, TaskState.WAITING) for tid in ids]], many=True)
+            # Task managers already loaded from this queue are in the data base
+            self._add_managers([manager for mid, manager in managers.items() if mid not in self._managers])
+        except Exception as exc:
+            self.db.rollback()
+            raise exc
         self._release_lock()
-        for tid, state in zip(ids, states):
-            if state == TaskState.WAITING:
-                self._update_waiting_task_state(tid=tid)
-            elif state in (TaskState.SUCCEEDED, TaskState.FAILED):
-                self._update_waiting_tasks(tid)
         if isscalar:
             return futures[0]
         return futures
@@ -733,14 +906,14 @@ class Queue(BaseClass):
     @property
     def state(self):
         """Get queue state ('ACTIVE' or 'PAUSED')."""
-        return self._query('SELECT value FROM metadata WHERE key="state"').fetchone()[0]
+        return self._query("SELECT value FROM metadata WHERE key='state'").fetchone()[0]
 
     @state.setter
     def state(self, state):
         """Set queue state ('ACTIVE' or 'PAUSED')."""
         if state not in (QueueState.ACTIVE, QueueState.PAUSED):
             raise ValueError('Invalid queue state {}; should be {} or {}'.format(state, QueueState.ACTIVE, QueueState.PAUSED))
-        self._query(['UPDATE metadata SET value=? where key="state"', (state,)])
+        self._query(["UPDATE metadata SET value=? WHERE key='state'", (state,)])
         self.db.commit()
 
     def pause(self):
@@ -758,69 +931,80 @@ class Queue(BaseClass):
 
     def set_task_state(self, tid, state):
         """Set the state of task with input ID ``tid`` to ``state``."""
+        # State update and promotion of dependent tasks within a single transaction
+        self._get_lock()
         try:
-            self._get_lock()
+            row = self._query(['SELECT state FROM tasks WHERE tid=?', (tid,)]).fetchone()
             query = 'UPDATE tasks SET state=? WHERE tid=?'
             self._query([query, (state, tid)])
-            self.db.commit()
+            if row is not None:
+                self._update_pending_requires(tid, row[0], state)
+        except Exception as exc:
+            self.db.rollback()
+            raise exc
+        self._release_lock()
 
-            if state in (TaskState.SUCCEEDED, TaskState.FAILED):
-                self._update_waiting_tasks(tid)
+    def _count_pending_requires(self, tids=None):
+        """
+        Count requirements that have not succeeded (column 'pending_requires') of tasks with IDs ``tids``;
+        if ``None``, of all tasks.
 
-        finally:
-            self._release_lock()
+        To be called within a transaction (see :meth:`_get_lock`).
+        """
+        query = 'UPDATE tasks SET pending_requires = (SELECT COUNT(DISTINCT d.require) FROM requires d JOIN tasks t ON d.require = t.tid WHERE d.tid = tasks.tid AND t.state != ?)'
+        if tids is None:
+            self._query([query, (TaskState.SUCCEEDED,)])
+        else:
+            self._query([query + ' WHERE tid=?', [(TaskState.SUCCEEDED, tid) for tid in tids]], many=True)
 
-    def _update_waiting_task_state(self, tid, force=False):
+    def _update_pending_requires(self, tid, previous_state, state):
         """
-        Check if all requirements of task of ID ``tid`` have finished running.
-        If so, set it into the task to 'PENDING' state.
+        Update the number of pending requirements of tasks that require task of ID ``tid``,
+        given its state changed from ``previous_state`` to ``state`` (``None`` if not in queue),
+        and set into 'PENDING' state those waiting tasks which requirements have all succeeded.
 
-        If ``force``, do the check no matter what. Otherwise, only proceed
-        with check if the task is still in the 'WAITING' state.
+        To be called within a transaction (see :meth:`_get_lock`).
         """
-        if not self._get_lock():
-            self.log_error('unable to get db lock; not updating waiting task state')
-            return
+        def pending(state):
+            return int(state is not None and state != TaskState.SUCCEEDED)
 
-        # Ensure that it is still waiting
-        # (another process could have moved it into pending)
-        if not force:
-            q = 'SELECT state FROM tasks WHERE tasks.tid=?'
-            row = self.db.execute(q, (tid,)).fetchone()
-            if row is None:
-                self._release_lock()
-                raise ValueError('Task ID {} not found'.format(tid))
-            if row[0] != TaskState.WAITING:
-                self._release_lock()
-                return
-
-        # Count number of requires that are still pending or waiting
-        query = 'SELECT COUNT(d.require) FROM requires d JOIN tasks t ON d.require = t.tid WHERE d.tid=? AND t.state IN (?, ?, ?, ?, ?, ?)'
-        row = self._query([query, (tid, TaskState.WAITING, TaskState.PENDING, TaskState.RUNNING, TaskState.FAILED, TaskState.KILLED, TaskState.UNKNOWN)]).fetchone()
-        self._release_lock()
-        if row is None:
+        delta = pending(state) - pending(previous_state)
+        if not delta:
             return
-        if row[0] == 0:
-            self.set_task_state(tid, TaskState.PENDING)
-        elif force:
-            self.set_task_state(tid, TaskState.WAITING)
-
-    def _update_waiting_tasks(self, tid):
-        """Identify tasks that are waiting for task of ID ``tid``, and call :meth:`_update_waiting_task_state` on them."""
-        query = 'SELECT t.tid FROM tasks t JOIN requires d ON d.tid=t.tid WHERE d.require=? AND t.state=?'
-        waiting_tasks = self._query([query, (tid, TaskState.WAITING)]).fetchall()
-        for tid in waiting_tasks:
-            self._update_waiting_task_state(tid[0])
+        query = 'UPDATE tasks SET pending_requires = pending_requires + ? WHERE tid IN (SELECT tid FROM requires WHERE require=?)'
+        self._query([query, (delta, tid)])
+        if delta < 0:
+            query = 'UPDATE tasks SET state=? WHERE state=? AND pending_requires=0 AND tid IN (SELECT tid FROM requires WHERE require=?)'
+            self._query([query, (TaskState.PENDING, TaskState.WAITING, tid)])
 
     def delete(self):
         """Delete data base :attr:`db` from both this instance and the disk."""
-        if hasattr(self, 'db'):
-            self.db.close()
-            del self.db
-        try:
-            os.remove(self.filename)
-        except OSError:
-            pass
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+        for fn in [self.filename, self.filename + '-wal', self.filename + '-shm']:
+            try:
+                os.remove(fn)
+            except OSError:
+                pass
+
+    def _load_task(self, tid, ptask):
+        # """Unpickle task, with a least-recently-used cache keyed by task ID and pickled task; return a copy, not sharing mutable attributes with the cached task."""
+        key = (tid, hash(ptask))
+        task = self._tasks.pop(key, None)
+        if task is None:
+            task = TaskUnpickler.loads(ptask, queue=self)
+            # Futures in task arguments are resolved when unpickling, with the current result of required tasks: do not cache
+            if task.require_ids:
+                return task
+        self._tasks[key] = task  # most recently used last
+        if len(self._tasks) > self._max_cached_tasks:
+            self._tasks.popitem(last=False)
+        new = task.copy()
+        new.app = task.app.copy()  # task manager is set on the returned app, see :meth:`tasks`
+        for name in ['kwargs', 'require_ids', 'versions', 'result']:
+            setattr(new, name, copy.deepcopy(getattr(task, name)))
+        return new
 
     def tasks(self, tid=None, mid=None, state=None, name=None, index=None, one=None, property=None):
         """
@@ -857,56 +1041,63 @@ class Queue(BaseClass):
         tasks : Task, list
             Task or property or property or list of such objects.
         """
-        # View as list
-        select = []
+        if tid is not None and one is None:
+            one = True
+        if name is not None and index is not None:
+            one = True
+        tasks = self.iter_tasks(tid=tid, mid=mid, state=state, name=name, index=index, property=property)
+        if one:
+            return next(tasks, None)
+        return list(tasks)
+
+    def iter_tasks(self, tid=None, mid=None, state=None, name=None, index=None, property=None):
+        """
+        Iterate over tasks in queue, fetching them from the data base one at a time.
+        Same parameters as :meth:`tasks`, but for ``one``.
+        Do not modify the queue while iterating; else use :meth:`tasks`.
+
+        Returns
+        -------
+        tasks : generator
+            Generator of tasks or property.
+        """
+        select, args = [], []
         if tid is not None:
-            select.append('tid="{}"'.format(tid))
-            if one is None: one = True
+            select.append('tid=?')
+            args.append(tid)
         if mid is not None:
-            select.append('mid="{}"'.format(mid))
+            select.append('mid=?')
+            args.append(mid)
         if state is not None:
-            select.append('state="{}"'.format(state))
-        query = 'SELECT task, tid, state, mid FROM tasks'
+            select.append('state=?')
+            args.append(state)
+        if property not in (None, 'tid', 'state', 'task_manager'):
+            raise ValueError('unkown property {}'.format(property))
+        # Pickled tasks are only needed to return tasks, or select them by name / index
+        load_task = name is not None or index is not None or property is None
+        # Bound arguments: same query string for the same selection, hence statements are cached by sqlite3
+        query = 'SELECT {}, tid, state, mid FROM tasks'.format('task' if load_task else 'NULL')
         if select: query += ' WHERE {}'.format(' AND '.join(select))
-        tasks = self._query(query)
-        if one:
-            tasks = tasks.fetchone()
-            if tasks is None: return None
-            tasks = [tasks]
-        else:
-            tasks = tasks.fetchall()
-            if tasks is None: return []
-        if name is not None and index is not None:
-            one = True
-        toret = []
-        for task in tasks:
-            (ptask, tid, state, mid), task = task, None
-            if name is not None or index is not None or property is None:
-                task = TaskUnpickler.loads(ptask, queue=self)
+        for ptask, tid, state, mid in self._query([query, tuple(args)]):
+            if load_task:
+                task = self._load_task(tid, ptask)
                 if name is not None and task.app.name != name:
                     continue
                 if index is not None and task.index != index:
                     continue
             if property == 'tid':
-                toret.append(tid)
+                yield tid
                 continue
             if property == 'state':
-                toret.append(state)
+                yield state
                 continue
             task_manager = self.managers(mid=mid)
             if property == 'task_manager':
-                toret.append(task_manager)
+                yield task_manager
                 continue
-            if property is not None:
-                raise ValueError('unkown property {}'.format(property))
             task.update(state=state)
             task.app.task_manager = task_manager
-            toret.append(task)
-        if one:
-            if len(toret):
-                return toret[0]
-            return None
-        return toret
+            yield task
 
     def pop(self, tid=None, mid=None):
         """
@@ -924,21 +1115,61 @@ class Queue(BaseClass):
         -------
         task : Task
         """
+        tasks = self.pop_many(1, tid=tid, mid=mid)
+        if tasks:
+            return tasks[0]
+        return None
+
+    def pop_many(self, n, tid=None, mid=None):
+        """
+        Retrieve up to ``n`` tasks to be run (i.e. in 'PENDING' state),
+        setting them into 'RUNNING' state within a single transaction.
+
+        Parameters
+        ----------
+        n : int
+            Maximum number of tasks to pop.
+
+        tid : str, default=None
+            If not ``None``, pop the task with given ID.
+
+        mid : str, default=None
+            If not ``None``, pop tasks with given task manager ID.
+
+        Returns
+        -------
+        tasks : list
+            List of :class:`Task` (empty if no task to be run).
+        """
         # First make sure we are not paused
         if self.state == QueueState.PAUSED:
-            return None
+            return []
 
-        if self._get_lock():
-            task = self.tasks(tid=tid, mid=mid, state=TaskState.PENDING, one=True)
-        else:
+        if not self._get_lock():
             self.log_warning("There may be tasks left in queue but I couldn't get lock to see")
-            return None
+            return []
+        try:
+            select, args = ['state=?'], [TaskState.PENDING]
+            if tid is not None:
+                select.append('tid=?')
+                args.append(tid)
+            if mid is not None:
+                select.append('mid=?')
+                args.append(mid)
+            query = 'SELECT tid, task, mid FROM tasks WHERE {} LIMIT ?'.format(' AND '.join(select))
+            rows = self._query([query, tuple(args) + (n,)]).fetchall()
+            self._query(['UPDATE tasks SET state=? WHERE tid=?', [(TaskState.RUNNING, row[0]) for row in rows]], many=True)
+        except Exception as exc:
+            self.db.rollback()
+            raise exc
         self._release_lock()
-        if task is None:
-            return None
-        self.set_task_state(task.id, TaskState.RUNNING)
-        task.update(state=TaskState.RUNNING)
-        return task
+        tasks = []
+        for tid, ptask, mid in rows:
+            task = self._load_task(tid, ptask)
+            task.update(state=TaskState.RUNNING)
+            task.app.task_manager = self.managers(mid=mid)
+            tasks.append(task)
+        return tasks
 
     def managers(self, mid=None, property=None):
         """
@@ -958,11 +1189,14 @@ class Queue(BaseClass):
         tm : TaskManager, list
            Task manager or property or list of such objects.
         """
-        query = 'SELECT mid, manager FROM managers'
         one = mid is not None
+        if one and property is None and mid in self._managers:
+            return self._managers[mid]
+        query, args = 'SELECT mid, manager FROM managers', ()
         if one:
-            query += ' WHERE mid="{}"'.format(mid)
-        managers = self._query(query).fetchall()
+            query += ' WHERE mid=?'
+            args = (mid,)
+        managers = self._query([query, args]).fetchall()
         if managers is None:
             return None
         toret = []
@@ -971,7 +1205,14 @@ class Queue(BaseClass):
             if property in ('mid', 'tid'):
                 toret.append(mid)
                 continue
-            toret.append(TaskManagerUnpickler.loads(manager, queue=self))
+            # Task managers are loaded once; the same ID means the same environ, scheduler and provider
+            if mid not in self._managers:
+                if isinstance(manager, bytes):  # pickled task manager
+                    self._managers[mid] = TaskManagerUnpickler.loads(manager, queue=self)
+                    self._managers[mid].id = mid  # as saved in the queue
+                else:
+                    self._managers[mid] = TaskManager.from_dict(json.loads(manager), queue=self)
+            toret.append(self._managers[mid])
         if one:
             return toret[0]
         return toret
@@ -992,14 +1233,25 @@ class Queue(BaseClass):
         -------
         counts : int
         """
-        select = []
+        select, args = [], []
         if mid is not None:
-            select.append('mid="{}"'.format(mid))
+            select.append('mid=?')
+            args.append(mid)
         if state is not None:
-            select.append('state="{}"'.format(state))
+            select.append('state=?')
+            args.append(state)
         query = 'SELECT count(state) FROM tasks'
         if select: query += ' WHERE {}'.format(' AND '.join(select))
-        return self._query(query).fetchone()[0]
+        return self._query([query, tuple(args)]).fetchone()[0]
+
+    def _counts_by_state(self, mid=None):
+        # """Return a dictionary mapping each state of :attr:`TaskState.ALL` to its number of tasks, in a single grouped query."""
+        query, args = 'SELECT state, count(*) FROM tasks', ()
+        if mid is not None:
+            query += ' WHERE mid=?'
+            args = (mid,)
+        counts = dict(self._query([query + ' GROUP BY state', args]).fetchall())
+        return {state: counts.get(state, 0) for state in TaskState.ALL}
 
     def summary(self, mid=None, return_type='dict'):
         """
@@ -1018,7 +1270,7 @@ class Queue(BaseClass):
         -------
         summary : dict, str
         """
-        counts = {state: self.counts(mid=mid, state=state) for state in TaskState.ALL}
+        counts = self._counts_by_state(mid=mid)
         if return_type == 'dict':
             return counts
         if return_type == 'str':
@@ -1046,8 +1298,15 @@ class Queue(BaseClass):
         if not self._get_lock():
             self.log_error('unable to get db lock; not deleting tasj')
             return
-        query = 'DELETE FROM tasks WHERE tid=?'
-        self._query([query, (tid,)])
+        try:
+            row = self._query(['SELECT state FROM tasks WHERE tid=?', (tid,)]).fetchone()
+            query = 'DELETE FROM tasks WHERE tid=?'
+            self._query([query, (tid,)])
+            if row is not None:  # deleted requirements do not block other tasks
+                self._update_pending_requires(tid, row[0], None)
+        except Exception as exc:
+            self.db.rollback()
+            raise exc
         self._release_lock()
 
     def __getstate__(self):
@@ -1055,7 +1314,7 @@ class Queue(BaseClass):
         return {'filename': self.filename}
 
     def __setstate__(self, state):
-        """Set queue state, from the file name."""
+        """Set queue state, from the file name (connection to the data base is opened on first use)."""
         self.__init__(state['filename'], base_dir='', create=False, spawn=False)
 
 
@@ -1082,8 +1341,11 @@ class BaseApp(BaseClass):
 
     task_manager : TaskManager
         Task manager to which the task has been added.
+
+    io_bound : bool
+        Whether the task mostly waits (e.g. for I/O); such tasks popped together by a worker are run concurrently, see :func:`work`.
     """
-    def __init__(self, func, task_manager=None, skip=False, name=None, write_attrs=('code', 'versions'), write_dir=None):
+    def __init__(self, func, task_manager=None, skip=False, name=None, write_attrs=('code', 'versions'), write_dir=None, io_bound=False):
         """
         Initialize application, called by :class:`TaskManager` decorators :meth:`TaskManager.bash_app` and :meth:`TaskManager.python_app`.
 
@@ -1099,7 +1361,7 @@ class BaseApp(BaseClass):
             self.__dict__.update(func.__dict__)
             return
         self.add = {'skip': False, 'name': None}
-        self.update(func=func, task_manager=task_manager, skip=skip, name=name, write_attrs=write_attrs, write_dir=write_dir)
+        self.update(func=func, task_manager=task_manager, skip=skip, name=name, write_attrs=write_attrs, write_dir=write_dir, io_bound=io_bound)
 
     def update(self, **kwargs):
         """Update app with input attributes."""
@@ -1139,6 +1401,8 @@ class BaseApp(BaseClass):
                 self.write_dir = str(self.write_dir)
             else:
                 self.write_dir = None
+        if 'io_bound' in kwargs:
+            self.io_bound = bool(kwargs.pop('io_bound'))
         if kwargs:
             raise ValueError('Unrecognized arguments {}'.format(kwargs))
 
@@ -1158,16 +1422,21 @@ class BaseApp(BaseClass):
             tid = queue.tasks(name=self.add['name'], index=self.index, property='tid')
             return Future(queue=queue, tid=tid)
         kwargs = inspect.getcallargs(self.func, *args, **kwargs)
-        return queue.add(Task(self, kwargs), replace=None)
+        task = Task(self, kwargs)
+        if queue._batch is not None:  # added to the queue at the end of :meth:`TaskManager.batch`
+            queue._batch.append(task)
+            return Future(queue=queue, tid=task.id)
+        return queue.add(task, replace=None)
 
     def __getstate__(self):
         """Return app state."""
-        state = {name: getattr(self, name) for name in ['name', 'code', 'params', 'filename', 'dirname', 'write_attrs', 'write_dir', 'task_manager']}
+        state = {name: getattr(self, name) for name in ['name', 'code', 'params', 'filename', 'dirname', 'write_attrs', 'write_dir', 'io_bound', 'task_manager']}
         return state
 
     def __setstate__(self, state):
         """Set app state."""
         self.add = {'skip': False, 'name': None}
+        self.io_bound = False  # apps saved before io_bound was introduced
         self.__dict__.update(state)
         self.func = deserialize_function(self.name, self.code, dict.fromkeys(self.params))
 
@@ -1187,7 +1456,64 @@ def select_modules(modules):
 
 _modules = select_modules(sys.modules)
 
-_sout, _serr = io.StringIO(), io.StringIO()
+
+class _ThreadStream(io.TextIOBase):
+
+    # """Text stream writing to the buffer of the current thread if set (see :func:`_capture_std`), else to the wrapped stream."""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        return getattr(self.local, 'buffer', self.stream).write(text)
+
+    def flush(self):
+        return getattr(self.local, 'buffer', self.stream).flush()
+
+    def writable(self):
+        return True
+
+    # Binary buffer, file descriptor, etc. are those of the wrapped stream
+    @property
+    def encoding(self):
+        return self.stream.encoding
+
+    @property
+    def errors(self):
+        return self.stream.errors
+
+    @property
+    def buffer(self):
+        return self.stream.buffer
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def isatty(self):
+        return self.stream.isatty()
+
+
+_capture = {'lock': threading.Lock(), 'count': 0}
+
+
+@contextlib.contextmanager
+def _capture_std():
+    # """Capture standard output and error of the current thread only (other threads may run apps concurrently); yield (out, err) buffers."""
+    with _capture['lock']:
+        if _capture['count'] == 0:
+            sys.stdout, sys.stderr = _ThreadStream(sys.stdout), _ThreadStream(sys.stderr)
+        _capture['count'] += 1
+        stdout, stderr = sys.stdout, sys.stderr
+    sout, serr = stdout.local.buffer, stderr.local.buffer = io.StringIO(), io.StringIO()
+    try:
+        yield sout, serr
+    finally:
+        del stdout.local.buffer, stderr.local.buffer
+        with _capture['lock']:
+            _capture['count'] -= 1
+            if _capture['count'] == 0:
+                sys.stdout, sys.stderr = stdout.stream, stderr.stream
 
 
 class PythonApp(BaseApp):
@@ -1201,36 +1527,32 @@ class PythonApp(BaseApp):
             print('hello' * n)
 
     """
+    def __call__(self, *args, **kwargs):
+        """Call the decorator, i.e. add task to the queue; without task manager, :attr:`func` is simply called in the current process."""
+        if self.task_manager is None:
+            return self.func(*args, **kwargs)
+        return super(PythonApp, self).__call__(*args, **kwargs)
+
     def run(self, *args, **kwargs):
         """Run app with input ``args`` and ``kwargs``."""
         errno, result, err, out, versions = 0, None, '', '', {}
         if self.dirname not in sys.path:
             sys.path.insert(0, self.dirname)
-        
-        def clear(*streams):
-            for stream in streams:
-                stream.seek(0)
-                stream.truncate(0)
-        
-        # we shall use previous streams, as they may have been imported already
-        clear(_sout, _serr)
-        with contextlib.redirect_stdout(_sout), contextlib.redirect_stderr(_serr):
+        with _capture_std() as (sout, serr):
             try:
                 result = self.func(*args, **kwargs)
             except Exception as exc:
                 errno = getattr(exc, 'errno', 42)
-                traceback.print_exc(file=err)
+                traceback.print_exc(file=serr)
                 # raise exc
             versions = self.versions()
-            out, err = _sout.getvalue(), _serr.getvalue()
-        clear(_sout, _serr)
-        
+            out, err = sout.getvalue(), serr.getvalue()
         return errno, result, err, out, versions
 
     def versions(self):
         """Return module versions."""
         versions = {}
-        for name in select_modules(sys.modules) - _modules:
+        for name in select_modules(set(sys.modules)) - _modules:
             try:
                 versions[name] = sys.modules[name].__version__
             except (KeyError, AttributeError):
@@ -1253,8 +1575,11 @@ class BashApp(BaseApp):
         """Run app with input ``args`` and ``kwargs``."""
         errno, result, out, err = 0, None, '', ''
         cmd = self.func(*args, **kwargs)
+        if isinstance(cmd, str):
+            cmd = shlex.split(cmd)  # no intermediate shell
         proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, stdout=subprocess.PIPE, text=True, shell=False)
         out, err = proc.communicate()
+        errno = proc.returncode
         return errno, result, err, out, {}
 
 
@@ -1358,8 +1683,8 @@ class TaskManager(BaseClass):
                 setattr(self, name, func(kwargs.pop(name)))
                 if name != 'queue': require_id = True
         if require_id:
-            uid = pickle.dumps((self.environ, self.scheduler, self.provider))
-            hex = hashlib.md5(uid).hexdigest()
+            uid = pickle.dumps((self.environ, self.scheduler, self.provider), protocol=pickle.HIGHEST_PROTOCOL)
+            hex = hashlib.blake2b(uid, digest_size=16).hexdigest()
             self.id = str(uuid.UUID(hex=hex))  # unique ID, tied to the given environ, scheduler, provider
         if kwargs:
             raise ValueError('Unrecognized arguments {}'.format(kwargs))
@@ -1371,10 +1696,79 @@ class TaskManager(BaseClass):
         return new
 
     def __getstate__(self):
-        return {name: getattr(self, name) for name in ['queue', 'environ', 'scheduler', 'provider']}
+        return {name: getattr(self, name) for name in ['queue', 'environ', 'scheduler', 'provider', 'id']}
 
     def __setstate__(self, state):
+        state = dict(state)
+        id = state.pop('id', None)
         self.update(**state)
+        if id is not None: self.id = id  # as saved in the queue, not recomputed from the (possibly rebuilt) environ, scheduler, provider
+
+    def to_dict(self):
+        """
+        Return task manager as a JSON-serializable dictionary, with :attr:`id` and the specifications
+        of :attr:`environ`, :attr:`scheduler`, :attr:`provider`; see :meth:`from_dict`.
+        """
+        def environ_to_dict(environ):
+            return {'environ': environ.name, 'data': environ.to_dict(), 'command': environ.command}
+
+        scheduler, provider = self.scheduler, self.provider
+        return {'id': self.id, 'environ': environ_to_dict(self.environ),
+                'scheduler': {'scheduler': scheduler.name, **{name: getattr(scheduler, name) for name in scheduler._defaults}},
+                'provider': {'provider': provider.name, 'environ': environ_to_dict(provider.environ), **{name: getattr(provider, name) for name in provider._defaults}}}
+
+    @classmethod
+    def from_dict(cls, state, queue=None):
+        """Build task manager from dictionary returned by :meth:`to_dict`, attached to the input ``queue``."""
+        def environ_from_dict(state):
+            return get_environ(state['environ'], data=state['data'], command=state['command'])
+
+        provider = dict(state['provider'])
+        provider['environ'] = environ_from_dict(provider['environ'])
+        new = cls.__new__(cls)
+        new.update(queue=queue, environ=environ_from_dict(state['environ']), scheduler=dict(state['scheduler']), provider=provider)
+        new.id = state['id']  # as saved in the queue
+        return new
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Context manager to add all tasks created within it to :attr:`queue` (by this or any other task manager with the same queue)
+        at once, in a single transaction, e.g.:
+
+        .. code-block:: python
+
+            with tm.batch():
+                futures = [test(n) for n in range(10)]
+
+        """
+        queue = self.queue
+        if queue._batch is not None:  # nested: tasks are added by the outermost context
+            yield
+            return
+        queue._batch = []
+        try:
+            yield
+            batch = queue._batch
+        finally:
+            queue._batch = None
+        if batch:
+            queue.add(batch, replace=None)
+
+    def map(self, app, iterable):
+        """
+        Call application ``app`` (e.g. decorated by :meth:`python_app`) on each element of ``iterable``,
+        a tuple of positional arguments or a dictionary of keyword arguments;
+        all tasks are added to the queue at once (see :meth:`batch`).
+
+        Returns
+        -------
+        futures : FutureList
+            List of :class:`Future`.
+        """
+        with self.batch():
+            futures = [app(**args) if isinstance(args, dict) else app(*args) for args in iterable]
+        return FutureList(futures)
 
     @decorator
     def python_app(self, func, **kwargs):
@@ -1392,7 +1786,7 @@ class TaskManager(BaseClass):
         self.scheduler(*args, **kwargs)
 
 
-def work(queue, mid=None, tid=None, mpicomm=None, mpisplits=None):
+def work(queue, mid=None, tid=None, mpicomm=None, mpisplits=None, nbatch=1):
     """
     Do the actual work: pop tasks from the input queue, and run them.
 
@@ -1407,43 +1801,70 @@ def work(queue, mid=None, tid=None, mpicomm=None, mpisplits=None):
     tid : str, default=None
         If not ``None``, take a task with this task ID.
 
-    mpicomm : MPI communicator, default=mpi.COMM_WORLD
-        The MPI communicator.
+    mpicomm : MPI communicator, default=None
+        The MPI communicator. Defaults to ``MPI.COMM_WORLD`` in the main thread, else to a duplicate of ``MPI.COMM_SELF``.
+
+    nbatch : int, default=1
+        Number of tasks to pop from the queue at once.
+        Larger values reduce the database overhead for short tasks, at the cost of load balancing between workers.
+        Without MPI, I/O-bound tasks (see :attr:`BaseApp.io_bound`) popped together are run concurrently in threads.
     """
+    tasks, running = [], []
+
     def exit_killed(*args):
-        task.state = TaskState.KILLED
-        queue.add(task, replace=True)
+        for task in running:
+            task.state = TaskState.KILLED
+            queue.add(task, replace=True)
+        for other in tasks:  # give back tasks that were popped but not run
+            queue.set_task_state(other.id, TaskState.PENDING)
         exit()
     
-    signal.signal(signal.SIGINT, exit_killed)
-    signal.signal(signal.SIGTERM, exit_killed)
+    main_thread = threading.current_thread() is threading.main_thread()  # else, e.g. run by :class:`ThreadProvider`
+    if main_thread:
+        signal.signal(signal.SIGINT, exit_killed)
+        signal.signal(signal.SIGTERM, exit_killed)
 
+    from mpi4py import MPI
     if mpicomm is None:
-        from mpi4py import MPI
-        mpicomm = MPI.COMM_WORLD
+        # Threads may work concurrently in the same process: each gets its own single-process communicator
+        mpicomm = MPI.COMM_WORLD if main_thread else MPI.COMM_SELF.Dup()
     if mpisplits is not None:
         for isplit in range(mpisplits):
             if (mpicomm.size * isplit // mpisplits) <= mpicomm.rank < (mpicomm.size * (isplit + 1) // mpisplits):
                 color = isplit
         mpicomm = mpicomm.Split(color, 0)
-    MPI.COMM_WORLD = mpicomm  # a bit hacky
-    while True:
-        task = None
-        # print(queue.summary(), queue.counts(state='PENDING'))
-        if mpicomm.rank == 0:
-            task = TaskPickler.dumps(queue.pop(mid=mid, tid=tid), reduce_app=None)
-        task = TaskUnpickler.loads(mpicomm.bcast(task, root=0))
-        if task is None:
-            break
+    if main_thread:
+        MPI.COMM_WORLD = mpicomm  # a bit hacky
+
+    def run(task):
         kwargs = {}
         if 'mpicomm' in task.kwargs and task.kwargs['mpicomm'] is None:
             kwargs['mpicomm'] = mpicomm
         task.run(**kwargs)
-        mpicomm.barrier()
-        # print(task.out)
-        # task.update(jobid=environ.get('DESIPIPE_JOBID', ''))
+
+    while True:
+        # print(queue.summary(), queue.counts(state='PENDING'))
         if mpicomm.rank == 0:
-            queue.add(task, replace=True)
+            tasks = TaskPickler.dumps(queue.pop_many(nbatch, mid=mid, tid=tid), reduce_app=None)
+        tasks = TaskUnpickler.loads(mpicomm.bcast(tasks, root=0))
+        if not tasks:
+            break
+        while tasks:
+            if mpicomm.size == 1 and tasks[0].app.io_bound:
+                running = [task for task in tasks if task.app.io_bound]
+                tasks = [task for task in tasks if not task.app.io_bound]
+                with concurrent.futures.ThreadPoolExecutor(max_workers=len(running)) as pool:
+                    list(pool.map(run, running))
+            else:
+                running = [tasks.pop(0)]
+                run(running[0])
+            mpicomm.barrier()
+            # print(task.out)
+            # task.update(jobid=environ.get('DESIPIPE_JOBID', ''))
+            if mpicomm.rank == 0:
+                for task in running:
+                    queue.add(task, replace=True)
+            running = []
 
 
 def spawn(queue, timeout=1e4, timestep=1.):
@@ -1466,7 +1887,8 @@ def spawn(queue, timeout=1e4, timestep=1.):
     t0 = time.time()
     stop = False
     qmanagers = [{} for i in range(len(queues))]
-    while True:
+    ncheckpoint = 100  # checkpoint write-ahead logs every ncheckpoint iterations
+    for istep in itertools.count(1):
         time.sleep(timestep * random.uniform(0.8, 1.2))
         if (time.time() - t0) > timeout:
             break
@@ -1476,7 +1898,10 @@ def spawn(queue, timeout=1e4, timestep=1.):
         for queue, managers in zip(queues, qmanagers):
             if queue.paused:
                 continue
-            if queue.counts(state=TaskState.PENDING) or (queue.counts(state=TaskState.WAITING) and queue.counts(state=TaskState.RUNNING)):
+            if istep % ncheckpoint == 0:
+                queue._checkpoint()
+            counts = queue._counts_by_state()
+            if counts[TaskState.PENDING] or (counts[TaskState.WAITING] and counts[TaskState.RUNNING]):
                 stop = False
             for manager in queue.managers():
                 if manager.id not in managers:
@@ -1541,7 +1966,8 @@ def action_from_args(action='work', args=None):
     logger = logging.getLogger('desipipe')
     from .utils import setup_logging
 
-    setup_logging()
+    if threading.current_thread() is threading.main_thread():  # else, e.g. worker of :class:`ThreadProvider`, keep logging of the current process
+        setup_logging()
 
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
@@ -1565,10 +1991,11 @@ def action_from_args(action='work', args=None):
         parser.add_argument('--mid', type=str, required=False, default=None, help='Task manager ID')
         parser.add_argument('--tid', type=str, required=False, default=None, help='Task ID')
         parser.add_argument('--mpisplits', type=int, required=False, default=None, help='Number of MPI splits')
+        parser.add_argument('--nbatch', type=int, required=False, default=1, help='Number of tasks to pop from the queue at once')
         args = parser.parse_args(args=args)
         if '*' in args.queue:
             raise ValueError('Provide single queue!')
-        return work(get_queue(args.queue, create=False), mid=args.mid, tid=args.tid, mpisplits=args.mpisplits)
+        return work(get_queue(args.queue, create=False), mid=args.mid, tid=args.tid, mpisplits=args.mpisplits, nbatch=args.nbatch)
 
     if action == 'tasks':
 
@@ -1580,15 +2007,15 @@ def action_from_args(action='work', args=None):
         if '*' in args.queue:
             raise ValueError('Provide single queue!')
         for state in args.state:
-            tasks = get_queue(args.queue, create=False).tasks(state=state, mid=args.mid, tid=args.tid)
-            if tasks:
-                logger.info('Tasks that are {}:'.format(state))
-                for task in tasks:
-                    logger.info('app: {}'.format(task.app.name))
-                    if task.errno is not None:
-                        for name in ['jobid', 'errno', 'err', 'out']:
-                            logger.info('{}: {}'.format(name, getattr(task, name)))
-                    logger.info('=' * 20)
+            tasks = get_queue(args.queue, create=False).iter_tasks(state=state, mid=args.mid, tid=args.tid)
+            for itask, task in enumerate(tasks):
+                if itask == 0:
+                    logger.info('Tasks that are {}:'.format(state))
+                logger.info('app: {}'.format(task.app.name))
+                if task.errno is not None:
+                    for name in ['jobid', 'errno', 'err', 'out']:
+                        logger.info('{}: {}'.format(name, getattr(task, name)))
+                logger.info('=' * 20)
         return
 
     parser.add_argument('-q', '--queue', nargs='*', type=str, required=True, help='Name of queue; user/queue to select user != {} and e.g. */* to select all queues of all users)'.format(Config.default_user))
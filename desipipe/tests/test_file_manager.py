@@ -1,3 +1,7 @@
+import os
+import pickle
+import tempfile
+
 from desipipe import FileManager
 
 
@@ -13,6 +17,137 @@ def test_file_manager():
     fmp.write('_tests/test_file_manager2.yaml')
 
 
+def test_extend():
+
+    fm = FileManager(environ=dict(DESIPIPEENVDIR='.'))
+    entry = dict(description='Power spectrum', id='power', filetype='power', path='power_{i:d}.npy', options={'i': range(2)})
+    fm.extend([entry, {**entry, 'id': 'power2', 'path': 'power2_{i:d}.npy'}])
+    assert [entry.id for entry in fm.data] == ['power', 'power2']
+    assert all(entry.environ is fm.environ for entry in fm.data)
+    fm.extend(fm.data[:1])  # file entries are copied
+    assert len(fm) == 3 and fm.data[2] is not fm.data[0] and fm.data[2].id == 'power'
+    assert len(fm.filepaths) == 6
+
+
+def test_add():
+
+    fm = FileManager(environ=dict(DESIPIPEENVDIR='.'))
+    fm.append(dict(id='power', filetype='power', path='power.npy'))
+    other = FileManager(environ=dict())
+    other.append(dict(id='catalog', filetype='catalog', path='catalog.fits'))
+    new = fm + other
+    assert new is not fm and len(fm) == 1
+    assert [entry.id for entry in new.data] == ['power', 'catalog']
+    alias = fm
+    fm += other  # in place: references to fm see appended entries
+    assert fm is alias
+    assert [entry.id for entry in alias.data] == ['power', 'catalog']
+    assert len(other) == 1 and fm.data[1] is not other.data[0]  # entries are copied
+    assert fm.data[1].environ is fm.environ
+
+
+def test_write():
+
+    from desipipe.file_manager import _move_tree
+
+    def write(fn, txt):
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, 'w') as file:
+            file.write(txt)
+
+    def read(fn):
+        with open(fn, 'r') as file:
+            return file.read()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src, dst = os.path.join(tmp_dir, 'src'), os.path.join(tmp_dir, 'dst')
+        write(os.path.join(src, 'a.txt'), 'new a')
+        write(os.path.join(src, 'sub', 'sub2', 'b.txt'), 'new b')
+        write(os.path.join(dst, 'a.txt'), 'old a')  # existing target: overwritten
+        write(os.path.join(dst, 'sub', 'c.txt'), 'old c')  # existing nested directory: merged
+        _move_tree(src, dst)
+        assert read(os.path.join(dst, 'a.txt')) == 'new a'
+        assert read(os.path.join(dst, 'sub', 'sub2', 'b.txt')) == 'new b'
+        assert read(os.path.join(dst, 'sub', 'c.txt')) == 'old c'
+        assert not os.listdir(src)
+        # Missing target directory: created
+        write(os.path.join(src, 'd.txt'), 'd')
+        dst = os.path.join(tmp_dir, 'missing', 'dst')
+        _move_tree(src, dst)
+        assert read(os.path.join(dst, 'd.txt')) == 'd'
+
+        fm = FileManager(environ=dict())
+        fm.append(dict(id='text', filetype='text', path=os.path.join(tmp_dir, 'missing2', 'hello_{i:d}.txt'), options={'i': range(2)}))
+        for fi in fm.data[0]:
+            fi.write('hello {:d}'.format(fi.options['i']))
+        fi.write('hello again')  # existing file
+        assert [fi.read() for fi in fm.data[0]] == ['hello 0', 'hello again']
+        assert sorted(os.listdir(os.path.join(tmp_dir, 'missing2'))) == ['hello_0.txt', 'hello_1.txt']  # no temporary directory left
+
+
+def test_state():
+
+    fm = FileManager(environ=dict())
+    fm.append(dict(description='Power spectrum', id='power', filetype='power', path='power_{i:d}.npy', options={'i': range(2)}))
+    assert len(fm.select(keywords='power')) == 1
+    fi = fm.get(id='power', i=1)
+    assert fi.filepath == 'power_1.npy'
+    # Cached attributes (e.g. sets, whose order depends on the hash seed) are not pickled, such that task IDs are reproducible
+    for file in [fm[0], fi]:
+        assert not any(name.startswith('_') for name in file.__getstate__())
+    assert pickle.loads(pickle.dumps(fi)).filepath == fi.filepath
+
+
+def test_numpy_options():
+
+    import numpy as np
+
+    fm = FileManager(environ=dict())
+    fm.append(dict(id='power', filetype='power', path='power_{i:d}_{z:.1f}.npy', options={'i': [np.int64(0), np.int64(1)], 'z': np.float64(0.5)}))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fn = os.path.join(tmp_dir, 'database.yaml')
+        fm.write(fn)  # numpy scalars are written as Python types
+        fm = FileManager(database=fn, environ=dict())
+    assert fm.data[0].options == {'i': [0, 1], 'z': [0.5]}
+    assert fm.filepaths == ['power_0_0.5.npy', 'power_1_0.5.npy']
+
+
+def test_range_options():
+
+    import pytest
+    from desipipe.file_manager import FileEntry
+
+    def get_options(values):
+        return FileEntry(id='power', filetype='power', path='power_{i:d}.npy', options={'i': values}).options['i']
+
+    assert list(get_options('range(3)')) == [0, 1, 2]
+    assert list(get_options('range( 1 , 7, 2 )')) == [1, 3, 5]
+    assert list(get_options('range(3, 0, -1)')) == [3, 2, 1]
+    assert list(get_options('range(0)')) == list(get_options('range(3, 0)')) == []
+    assert get_options('range') == ['range']  # not a range
+    for values in ['range(a)', 'range(1.5)', 'range(0, 3, 0)', 'range(1, 2, 3, 4)']:
+        with pytest.raises(ValueError):
+            get_options(values)
+
+
+def test_in_options():
+
+    import pytest
+    from desipipe.file_manager import in_options
+
+    assert in_options([2, 5, 0], [0, 1, 2], return_index=True) == ([2, 0], [2, 0])
+    assert in_options(1, [0., 1.]) == [1.]  # values cast to the options type
+    assert in_options(5, [0, 1, 2]) == [] and in_options(5, []) == []
+    options = [[0, 1], [1, 2]]  # unhashable options
+    assert in_options([1, 2], options) == [[1, 2]]
+    assert in_options([[1, 2], [2, 3]], options, return_index=True) == ([[1, 2]], [1])
+    with pytest.raises(ValueError):
+        in_options([[1]], [1, 2])
+
+
 if __name__ == '__main__':
 
-    test_file_manager()
\ No newline at end of file
+    test_file_manager()
+    test_numpy_options()
+    test_range_options()
+    test_in_options()
@@ -1,10 +1,14 @@
+import io
 import os
 import time
 
 from desipipe import Queue, Environment, TaskManager, FileManager
+from desipipe.file_manager import FileEntry
+from desipipe.task_manager import TaskPickler, TaskUnpickler
 
 
 base_dir = './_tests/'
+on_nersc = bool(os.getenv('NERSC_HOST', None))
 
 
 def test_app():
@@ -17,6 +21,7 @@ def test_app():
 
     app = PythonApp(func)
     print(app.run((1, 1), {}))
+    assert app(2, 3) == 6  # no task manager: direct call
 
 
 def test_serialization():
@@ -35,26 +40,287 @@ def test_serialization():
     assert func2(1, 2) == 8.
 
 
+def test_journal_mode():
+
+    for wal, mode in [(False, 'delete'), (True, 'wal')]:
+        queue = Queue('test_journal_mode', base_dir=base_dir, create=True, wal=wal)
+        # Journal mode is saved in the queue
+        assert Queue('test_journal_mode', base_dir=base_dir, create=False).db.execute('PRAGMA journal_mode').fetchone()[0] == mode
+        queue.delete()
+
+
+def test_task_manager_state():
+
+    import json
+    import pickle
+
+    queue = Queue('test_task_manager_state', base_dir=base_dir, create=True)
+    tm = TaskManager(queue, environ=dict(VAR='value'), scheduler=dict(max_workers=3, nbatch=2), provider=dict(provider='local', mpiprocs_per_worker=2))
+    state = json.loads(json.dumps(tm.to_dict()))
+    tm2 = TaskManager.from_dict(state, queue=queue)
+    assert tm2.id == tm.id and tm2.to_dict() == tm.to_dict()
+    assert dict(tm2.environ) == {'VAR': 'value'} and (tm2.scheduler.max_workers, tm2.scheduler.nbatch) == (3, 2)
+    assert (tm2.provider.name, tm2.provider.mpiprocs_per_worker) == ('local', 2)
+
+    @tm.python_app
+    def f(a):
+        return a
+
+    f(1)
+    assert Queue('test_task_manager_state', base_dir=base_dir).managers(mid=tm.id).to_dict() == tm.to_dict()
+
+    # Queues written by previous versions: task managers saved as pickles
+    class Pickler(pickle.Pickler):
+
+        def persistent_id(self, obj):
+            if isinstance(obj, TaskManager):
+                state = obj.__getstate__()
+                state['queue'] = None
+                state.pop('id')
+                return ('TaskManager', state)
+            return None
+
+    file = io.BytesIO()
+    Pickler(file).dump(tm)
+    queue.db.execute('UPDATE managers SET manager=? WHERE mid=?', (file.getvalue(), tm.id))
+    queue = Queue('test_task_manager_state', base_dir=base_dir)
+    tm2 = queue.managers(mid=tm.id)
+    assert tm2.queue is queue and tm2.to_dict() == tm.to_dict()
+    assert queue.tasks()[0].app.task_manager is tm2
+    queue.delete()
+
+    # Task manager ID saved in the queue is kept when tasks are sent to and back from workers
+    queue = Queue('test_task_manager_state', base_dir=base_dir, create=True)
+    tm = TaskManager(queue, environ=dict(), scheduler=dict(max_workers=1), provider=dict(provider='slurm'))
+
+    @tm.python_app
+    def f(a):
+        return a
+
+    future = f(1)
+    queue = Queue('test_task_manager_state', base_dir=base_dir)
+    task = TaskUnpickler.loads(TaskPickler.dumps(queue.pop(tid=future.id), reduce_app=None))
+    task.run()
+    queue.add(task, replace=True)
+    assert queue.tasks(tid=future.id, property='task_manager').id == tm.id
+    assert queue.managers(property='mid') == [tm.id]
+    queue.delete()
+
+
+def test_requires():
+
+    queue = Queue('test_requires', base_dir=base_dir, create=True)
+    tm = TaskManager(queue, environ=dict(), scheduler=dict(max_workers=1), provider=dict(provider='local'))
+
+    @tm.python_app
+    def f(a):
+        return a
+
+    @tm.python_app
+    def g(a):
+        return a + 1
+
+    def run():
+        task = queue.pop()
+        task.run()
+        queue.add(task, replace=True)
+        return task
+
+    a = f(1)
+    c = g(a)
+    assert len(queue.tasks()) == 2  # c is loaded while waiting for a
+    assert run().id == a.id
+    task = run()
+    assert task.kwargs == {'a': 1} and task.state == 'SUCCEEDED'
+    assert c.result() == 2
+
+    # Same task added several times at once
+    with tm.batch():
+        futures = [f(5), f(5)]
+    assert futures[0].id == futures[1].id
+    futures = tm.map(f, [(6,), (6,), (5,)])
+    assert len(set(future.id for future in futures)) == 2
+    assert len(queue.tasks()) == 4
+
+    # Loaded tasks do not share mutable attributes with the cached ones
+    future = f([1])
+    task = queue.pop(tid=future.id)
+    task.run()
+    queue.add(task, replace=True)
+    task = queue.tasks(tid=future.id)
+    task.result.append(2)
+    task.kwargs['a'].append(2)
+    task = queue.tasks(tid=future.id)
+    assert task.result == [1] and task.kwargs == {'a': [1]}
+    queue.delete()
+
+
+def test_pending_requires():
+
+    queue = Queue('test_pending_requires', base_dir=base_dir, create=True)
+    tm = TaskManager(queue, environ=dict(), scheduler=dict(max_workers=1), provider=dict(provider='local'))
+
+    @tm.python_app
+    def f(a):
+        if a < 0:
+            raise ValueError('negative input')
+        return a
+
+    @tm.python_app
+    def g(a, b):
+        return a + b
+
+    def run(future, state='SUCCEEDED'):
+        task = queue.pop(tid=future.id)
+        task.run()
+        queue.add(task, replace=True)
+        assert task.state == state
+        return task
+
+    def state(future):
+        return queue.tasks(tid=future.id, property='state')
+
+    # Task set to 'PENDING' once all its requirements have succeeded
+    a, b = f(1), f(2)
+    c = g(a, b)
+    assert state(c) == 'WAITING'
+    task_a = run(a)
+    assert state(c) == 'WAITING'
+    run(b)
+    assert state(c) == 'PENDING'
+    run(c)
+    assert c.result() == 3
+
+    # Failed requirement: task keeps waiting
+    d = f(-1)
+    e = g(d, a)
+    assert state(e) == 'WAITING'
+    task_d = run(d, state='FAILED')
+    assert state(e) == 'WAITING'
+    # Replaced requirement: now succeeded
+    queue.add(task_d.clone(state='SUCCEEDED'), replace=True)
+    assert state(e) == 'PENDING'
+
+    # Requirement re-added to be run again: dependent task waits for it again
+    h = g(a, f(3))
+    assert state(h) == 'WAITING'
+    queue.add(task_a.clone(state='PENDING'), replace=True)
+    run(f(3))
+    assert state(h) == 'WAITING'
+    run(a)
+    assert state(h) == 'PENDING'
+    queue.delete()
+
+
+def test_io_bound():
+
+    from desipipe.task_manager import work
+
+    queue = Queue('test_io_bound', base_dir=base_dir, create=True)
+    tm = TaskManager(queue, environ=dict(), scheduler=dict(max_workers=1, nbatch=4), provider=dict(provider='local'))
+
+    @tm.python_app(io_bound=True)
+    def wait(i):
+        import time
+        time.sleep(1)
+        print('waited', i)
+        return i
+
+    futures = tm.map(wait, [(i,) for i in range(4)])
+    t0 = time.time()
+    work(queue, nbatch=4)
+    assert time.time() - t0 < 3.  # 4 tasks of 1 s run concurrently
+    assert futures.result() == list(range(4))
+    assert futures.out() == ['waited {:d}\n'.format(i) for i in range(4)]  # outputs are not mixed
+    queue.delete()
+
+
+def test_thread_provider():
+
+    from desipipe import spawn
+
+    queue = Queue('test_thread_provider', base_dir=base_dir, create=True)
+    # Workers run in a persistent thread pool of the current process
+    tm = TaskManager(queue, environ=dict(), scheduler=dict(max_workers=2), provider=dict(provider='thread'))
+
+    @tm.python_app
+    def square(x):
+        print('square', x)
+        return x * x
+
+    futures = tm.map(square, [(i,) for i in range(4)])
+    import logging
+    handlers = list(logging.root.handlers)
+    spawn(queue, timeout=60., timestep=0.1)
+    assert logging.root.handlers == handlers  # logging of the current process is not set up again by workers
+    assert futures.result() == [i * i for i in range(4)]
+    assert futures.out() == ['square {:d}\n'.format(i) for i in range(4)]
+    queue.delete()
+
+    from desipipe.task_manager import _ThreadStream
+    # Captured standard streams forward encoding, file descriptor, etc. to the original stream
+    with open(os.devnull, 'w') as file:
+        stream = _ThreadStream(file)
+        assert stream.encoding == file.encoding and stream.buffer is file.buffer and stream.fileno() == file.fileno()
+
+
+def test_as_numpy():
+
+    import numpy as np
+    from desipipe.task_manager import Future, FutureList
+
+    queue = Queue('test_as_numpy', base_dir=base_dir, create=True)
+    tm = TaskManager(queue, environ=dict(), scheduler=dict(max_workers=1), provider=dict(provider='local'))
+
+    @tm.python_app
+    def half(x):
+        return x / 2.
+
+    futures = tm.map(half, [(1,), (2,), (3,)])
+    for future in futures[:2]:
+        task = queue.pop(tid=future.id)
+        task.run()
+        queue.add(task, replace=True)
+    # Skipped task (None) and time out of the last (not run) task are set to NaN
+    futures = FutureList(futures + [None])
+    array = futures.as_numpy(timeout=1.)
+    assert np.allclose(array[:2], [0.5, 1.]) and np.isnan(array[2:]).all()
+    try:
+        futures.as_numpy(dtype='i8', timeout=1.)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('missing results cannot be integers')
+    # Task not in queue: no waiting
+    t0 = time.time()
+    assert Future(queue, 'missing').result(timeout=10.) is None and time.time() - t0 < 5.
+    queue.delete()
+
+
 def test_queue(spawn=True, run=False):
 
     queue = Queue('test', base_dir=base_dir, spawn=spawn)
     provider = dict(provider='local')
-    if False: # os.getenv('NERSC_HOST', None):
+    if False: # on_nersc:
         provider = dict(time='00:01:00', nodes_per_worker=0.1)
-    tm = TaskManager(queue, environ=dict(), scheduler=dict(max_workers=2), provider=provider)
+    tm = TaskManager(queue, environ=dict(), scheduler=dict(max_workers=2, nbatch=5), provider=provider)
     tm2 = tm.clone(scheduler=dict(max_workers=1), provider=dict(provider='local'))
 
     def common1(size):
         import time
         import numpy as np
         time.sleep(2)
-        x, y = np.random.uniform(-1, 1, size), np.random.uniform(-1, 1, size)
-        return np.sum((x**2 + y**2) < 1.) * 1. / size
+        # Single (size, 2) array of random coordinates, transformed in place
+        xy = np.random.default_rng().random((size, 2), dtype='f4')
+        xy *= 2.
+        xy -= 1.
+        np.square(xy, out=xy)
+        return np.mean(xy.sum(axis=1) < 1.)
 
     def common2(size, co=common1):
         return co(size=size)
 
-    @tm.python_app
+    @tm.python_app(io_bound=True)  # mostly sleeping: the (nbatch=5) tasks popped together by a worker are run concurrently
     def fraction(size=10000, co=common2):
         return co(size=size)
 
@@ -65,7 +331,7 @@ def test_queue(spawn=True, run=False):
     @tm2.python_app
     def average(fractions):
         import numpy as np
-        return np.average(fractions) * 4.
+        return np.asarray(fractions, dtype='f8').mean() * 4.
 
     @tm2.python_app(name='average')
     def average2(fractions):
@@ -76,7 +342,7 @@ def test_queue(spawn=True, run=False):
         return None
 
     t0 = time.time()
-    fractions = [fraction(size=1000 + i) for i in range(5)]
+    fractions = tm.map(fraction, [dict(size=1000 + i) for i in range(5)])
     ech = echo(fractions)
     avg = average(fractions)
     avg2 = average2(fractions)
@@ -85,6 +351,7 @@ def test_queue(spawn=True, run=False):
         print(queue.summary())
         print(ech.out())
         assert avg2.result() == avg.result()
+        assert abs(fractions.as_numpy().mean() * 4. - avg.result()) < 1e-12
         print(avg.result(), time.time() - t0)
 
     @tm2.bash_app(name=True)
@@ -111,16 +378,17 @@ def test_queue(spawn=True, run=False):
 
 def test_cmdline():
 
-    import subprocess
-    queue = "'./_tests/*'"
-    queue_single = "./_tests/test.sqlite"
-    subprocess.call(['desipipe', 'queues', '-q', queue])
-    subprocess.call(['desipipe', 'tasks', '-q', queue_single, '--state', 'SUCCEEDED'])
-    subprocess.call(['desipipe', 'delete', '-q', queue])
-    subprocess.call(['desipipe', 'pause', '-q', queue])
-    subprocess.call(['desipipe', 'resume', '-q', queue])
-    subprocess.call(['desipipe', 'spawn', '-q', queue])
-    subprocess.call(['desipipe', 'retry', '-q', queue, '--state', 'SUCCEEDED', '--spawn'])
+    from desipipe.__main__ import main
+    Queue('test', base_dir=base_dir)  # make sure the queue exists, as errors are raised in-process
+    queue = './_tests/*'
+    queue_single = './_tests/test.sqlite'
+    main(['queues', '-q', queue])
+    main(['tasks', '-q', queue_single, '--state', 'SUCCEEDED'])
+    main(['delete', '-q', queue])
+    main(['pause', '-q', queue])
+    main(['resume', '-q', queue])
+    main(['spawn', '-q', queue])
+    main(['retry', '-q', queue, '--state', 'SUCCEEDED', '--spawn'])
 
 
 def test_file(spawn=True):
@@ -128,14 +396,17 @@ def test_file(spawn=True):
     txt = 'hello world!'
 
     fm = FileManager()
-    fm.append(dict(description='added file', id='input', filetype='text', path=os.path.join(base_dir, 'hello_in_{i:d}.txt'), options={'i': range(10)}))
+    entry = FileEntry(description='added file', id='input', filetype='text', path=os.path.join(base_dir, 'hello_in_{i:d}.txt'), options={'i': range(10)})
+    # Output entry shares options with the input entry, which are parsed once
+    fm.extend([entry, entry.clone(id='output', path=os.path.join(base_dir, 'hello_out_{i:d}.txt'))])
+    assert [entry.id for entry in fm.data] == ['input', 'output']
+    payload = txt.encode()  # encoded once for all files
     for fi in fm:
-        fi.get().write(txt)
-    fm.append(fm[0].clone(id='output', path=os.path.join(base_dir, 'hello_out_{i:d}.txt')))
+        fi.get(id='input').write(payload)
 
     queue = Queue('test2', base_dir=base_dir, spawn=spawn)
     provider = None
-    if os.getenv('NERSC_HOST', None):
+    if on_nersc:
         provider = dict(time='00:02:00', nodes_per_worker=0.1)
     tm = TaskManager(queue, environ=dict(), scheduler=dict(max_workers=2), provider=provider)
 
@@ -146,14 +417,13 @@ def test_file(spawn=True):
         print('saving', text_out.rpath)
         text_out.write(text)
 
-    results = []
-    for fi in fm:
-        results.append(copy(fi.get(id='input'), fi.get(id='output')))
+    pairs = [(fi.get(id='input'), fi.get(id='output')) for fi in fm]
+    results = tm.map(copy, pairs)
 
     if spawn:
-        for res in results:
-            print('out', res.out())
-            print('err', res.err())
+        for out, err in zip(results.out(), results.err()):
+            print('out', out)
+            print('err', err)
 
     queue.delete()
 
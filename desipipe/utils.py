@@ -151,6 +151,8 @@ class BaseClass(object, metaclass=BaseMetaClass):
     Base class that implements :meth:`copy`.
     To be used throughout this package.
     """
+    __slots__ = ()  # such that subclasses can define __slots__; those which do not have a __dict__ as usual
+
     def __copy__(self, *args, **kwargs):
         new = self.__class__.__new__(self.__class__)
         new.__dict__.update(self.__dict__)
@@ -192,6 +194,8 @@ def dict_to_yaml(d):
     import numbers
     toret = {}
     for k, v in d.items():
+        if getattr(v, 'shape', None) == () and hasattr(v, 'item'):  # numpy scalars, not understood by the safe yaml dumper
+            v = v.item()
         if isinstance(v, dict):
             v = dict_to_yaml(v)
         elif is_sequence(v):